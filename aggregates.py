@@ -0,0 +1,95 @@
+"""
+Zeitgewichtete Kennwerte je gespeichertem Datensatz.
+
+Jeder Messwert gilt bis zum nächsten Messwert. Daraus werden
+Mittelwert, Minimum, Maximum und Anzahl der Messwerte über das
+gesamte Intervall zwischen zwei Datensätzen gebildet.
+"""
+from typing import Dict, Iterable, Optional
+
+CHANNELS = ("voltage", "current", "charge", "temperature")
+
+
+class ChannelAggregate:
+    """
+    Laufende Kennwerte eines Kanals mit konstantem Speicherbedarf
+    """
+
+    def __init__(self):
+        self.value: Optional[float] = None
+        self.since = 0.0
+        self.start = 0.0
+        self.integral = 0.0
+        self.minimum: Optional[float] = None
+        self.maximum: Optional[float] = None
+        self.samples = 0
+
+    def _hold(self, now: float) -> None:
+        if self.value is not None:
+            self.integral += self.value * (now - self.since)
+        self.since = now
+
+    def add(self, value: float, now: float) -> None:
+        if self.value is None:
+            # erster Messwert überhaupt
+            self.start = now
+        self._hold(now)
+        self.value = value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.samples += 1
+
+    def collect(self, now: float) -> dict:
+        """
+        Kennwerte des Intervalls zurückgeben und ein neues Intervall beginnen.
+
+        Der letzte Messwert gilt im neuen Intervall weiter.
+        """
+        self._hold(now)
+        duration = now - self.start
+        if duration > 0:
+            mean = self.integral / duration
+        else:
+            mean = self.value
+        result = {
+            "mean": mean,
+            "min": self.minimum if self.samples else self.value,
+            "max": self.maximum if self.samples else self.value,
+            "samples": self.samples,
+        }
+        self.start = now
+        self.integral = 0.0
+        self.minimum = self.maximum = self.value
+        self.samples = 0
+        return result
+
+
+class IntervalAggregates:
+    """
+    Kennwerte aller Kanäle zwischen zwei Datensätzen
+    """
+
+    def __init__(self, channels: Iterable[str] = CHANNELS):
+        self.channels: Dict[str, ChannelAggregate] = {
+            channel: ChannelAggregate() for channel in channels
+        }
+
+    def add(self, channel: str, value: float, now: float) -> None:
+        self.channels[channel].add(value, now)
+
+    def collect(self, now: float) -> dict:
+        """
+        Spalten für die Tabelle statistik.
+
+        Der zeitgewichtete Mittelwert wird als Wert des Kanals gespeichert.
+        """
+        columns = {}
+        for channel, aggregate in self.channels.items():
+            if aggregate.value is None:
+                continue
+            result = aggregate.collect(now)
+            columns[channel] = result["mean"]
+            columns[f"{channel}_min"] = result["min"]
+            columns[f"{channel}_max"] = result["max"]
+            columns[f"{channel}_samples"] = result["samples"]
+        return columns
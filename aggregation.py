@@ -0,0 +1,301 @@
+"""
+Auswertung der Statistik in Zeitintervallen.
+
+Die Zeilen werden je Zyklus am Stück in NumPy-Arrays geladen und nach
+Intervallen (Buckets) gruppiert. Alle Kennzahlen werden ohne Schleife
+über die Zeilen berechnet. Minimum, Maximum und die Anzahl der
+Messwerte kommen aus den Spalten _min, _max und _samples der Zeilen,
+sofern sie vorhanden sind (siehe aggregates.py).
+"""
+import datetime
+import json
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+import compression
+import dal
+from database import (
+    Session,
+    get_cycle_block,
+    get_cycles_in_range,
+    get_path,
+    get_session,
+    get_time_offsets,
+)
+from statistiken import CHANNELS, EPOCH, SECOND, local_delta
+
+STATISTICS = ("count", "samples", "min", "max", "mean", "std")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+PERCENTILE = re.compile(r"p(\d{1,2}(\.\d+)?|100)$")
+ROLLUPS = ("min", "max", "samples")
+
+
+def parse_width(width: str) -> int:
+    """
+    Breite der Intervalle in Sekunden, z. B. 900, 15m, 1h oder 1d.
+    """
+    match = re.fullmatch(r"(\d+)([smhd]?)", width.strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Ungültige Intervallbreite {width}")
+    return int(match.group(1)) * UNITS[match.group(2) or "s"]
+
+
+def parse_statistics(names: Sequence[str]) -> List[str]:
+    """
+    Kennzahlen prüfen, neben STATISTICS auch Perzentile wie p95.
+    """
+    for name in names:
+        if name not in STATISTICS and not PERCENTILE.match(name):
+            raise ValueError(f"Unbekannte Kennzahl {name}")
+    return list(names)
+
+
+def columns_for(channels: Sequence[str], statistics: Sequence[str]) -> List[str]:
+    """
+    Spalten der Tabelle statistik, die für die Kanäle und Kennzahlen
+    gelesen werden müssen.
+    """
+    columns = []
+    for channel in channels:
+        if channel in CHANNELS:
+            columns.append(channel)
+            columns += [f"{channel}_{name}" for name in ROLLUPS if name in statistics]
+    return columns
+
+
+def _cell_matrix(cell_voltages: Sequence[Sequence[Optional[float]]]) -> np.ndarray:
+    width = max((len(values) for values in cell_voltages), default=0)
+    return np.array(
+        [list(values) + [None] * (width - len(values)) for values in cell_voltages],
+        dtype=np.float64,
+    ).reshape(len(cell_voltages), width)
+
+
+def _load_cycle(
+    session: Session,
+    cycle: int,
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+    columns: Sequence[str],
+    cells: bool,
+) -> Dict[str, np.ndarray]:
+    """
+    Spalten eines Zyklus, die Zeitstempel korrigiert in Sekunden seit 1970 UTC.
+    """
+    with get_session(session, cycle) as cycle_session:
+        offsets = get_time_offsets(cycle_session, cycle)
+        block = get_cycle_block(cycle_session, cycle)
+    if block is not None:
+        # only the streams of the requested columns are decoded
+        cell_columns = [
+            name
+            for name in block.columns.split(",")
+            if cells and name.startswith("cell_")
+        ]
+        decoded = compression.decode_columns(block, [*columns, *cell_columns])
+        seconds = np.array(decoded["timestamp"], dtype=np.float64) / 1e6
+        if cells:
+            matrix = np.array(
+                [decoded[name] for name in cell_columns], dtype=np.float64
+            ).reshape(len(cell_columns), len(seconds))
+            decoded["cells"] = matrix.T
+    else:
+        # the stored timestamps are not corrected yet
+        margin = datetime.timedelta(seconds=sum(abs(delta) for *_, delta in offsets))
+        selected = ["row", "timestamp", *columns]
+        if cells:
+            selected.append("cell_voltages")
+        rows = dal.read_columns(
+            get_path(cycle),
+            cycle,
+            selected,
+            start and start - margin,
+            end and end + margin,
+        )
+        decoded = (
+            dict(zip(selected, zip(*rows))) if rows else dict.fromkeys(selected, ())
+        )
+        timestamps = np.array(decoded["timestamp"], dtype="datetime64[us]")
+        seconds = (timestamps - np.datetime64(EPOCH, "us")) / np.timedelta64(1, "s")
+        if cells:
+            # one call of the parser for all rows
+            texts = ",".join(text or "[]" for text in decoded["cell_voltages"])
+            decoded["cells"] = _cell_matrix(json.loads(f"[{texts}]"))
+    frame = {
+        name: np.array(decoded[name], dtype=np.float64) for name in ("row", *columns)
+    }
+    for row_from, row_to, delta in offsets:
+        seconds[(frame["row"] >= row_from) & (frame["row"] < row_to)] += delta
+    frame["timestamp"] = seconds
+    if cells:
+        frame["cells"] = decoded["cells"]
+    mask = np.ones(len(seconds), dtype=bool)
+    if start is not None:
+        mask &= seconds > (start - EPOCH) / SECOND
+    if end is not None:
+        mask &= seconds <= (end - EPOCH) / SECOND
+    return {name: column[mask] for name, column in frame.items()}
+
+
+def load(
+    session: Session,
+    cycles: Sequence[int],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    columns: Sequence[str] = CHANNELS,
+    cells: bool = False,
+) -> Dict[str, np.ndarray]:
+    """
+    Spalten mehrerer Zyklen, nach der Zeit sortiert.
+
+    Mit cells enthält frame["cells"] die Zellspannungen als Matrix.
+    """
+    frames = [
+        _load_cycle(session, cycle, start, end, columns, cells) for cycle in cycles
+    ]
+    frames = [frame for frame in frames if len(frame["timestamp"])]
+    if not frames:
+        return {}
+    if cells:
+        width = max(frame["cells"].shape[1] for frame in frames)
+        for frame in frames:
+            missing = width - frame["cells"].shape[1]
+            frame["cells"] = np.pad(
+                frame["cells"], ((0, 0), (0, missing)), constant_values=np.nan
+            )
+    merged = {
+        name: np.concatenate([frame[name] for frame in frames]) for name in frames[0]
+    }
+    order = np.argsort(merged["timestamp"], kind="stable")
+    return {name: column[order] for name, column in merged.items()}
+
+
+def _reduce(
+    name: str,
+    values: np.ndarray,
+    bounds: np.ndarray,
+    counts: np.ndarray,
+    minimum: Optional[np.ndarray] = None,
+    maximum: Optional[np.ndarray] = None,
+    samples: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Kennzahl je Intervall, bounds sind die ersten Indizes der Intervalle.
+    """
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if name == "count":
+            return counts.astype(np.float64)
+        if name == "samples":
+            if samples is None:
+                return counts.astype(np.float64)
+            # rows without rollup count as one sample
+            per_row = np.where(np.isnan(samples), valid, samples)
+            return np.add.reduceat(per_row, bounds)
+        if name == "min":
+            if minimum is not None:
+                values = np.where(np.isnan(minimum), values, minimum)
+            return np.fmin.reduceat(values, bounds)
+        if name == "max":
+            if maximum is not None:
+                values = np.where(np.isnan(maximum), values, maximum)
+            return np.fmax.reduceat(values, bounds)
+        total = np.add.reduceat(np.where(valid, values, 0.0), bounds)
+        mean = total / counts
+        if name == "mean":
+            return mean
+        if name == "std":
+            squares = np.add.reduceat(np.where(valid, values * values, 0.0), bounds)
+            return np.sqrt(np.maximum(squares / counts - mean * mean, 0.0))
+    # percentile with linear interpolation, NaN is sorted to the end
+    buckets = np.repeat(np.arange(len(bounds)), np.diff(np.append(bounds, len(values))))
+    ordered = values[np.lexsort((values, buckets))]
+    position = bounds + float(name[1:]) / 100 * np.maximum(counts - 1, 0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    fraction = position - lower
+    result = ordered[lower] + (ordered[upper] - ordered[lower]) * fraction
+    return np.where(counts > 0, result, np.nan)
+
+
+def aggregate(
+    frame: Dict[str, np.ndarray],
+    width: int,
+    channels: Sequence[str],
+    statistics: Sequence[str],
+) -> dict:
+    """
+    Kennzahlen der Kanäle je Intervall von width Sekunden.
+
+    Die Intervalle beginnen bei Vielfachen von width in Ortszeit,
+    Intervalle ohne Zeilen werden ausgelassen. Für die Zellen sind
+    die Kanäle cell_0, cell_1, ... oder cells für alle Zellen.
+    """
+    timestamps = frame.get("timestamp", np.empty(0))
+    if not len(timestamps):
+        return {"width": width, "timestamp": [], "channels": {}}
+    cells = frame["cells"].shape[1] if "cells" in frame else 0
+    if "cells" in channels:
+        channels = [channel for channel in channels if channel != "cells"]
+        channels += [f"cell_{cell}" for cell in range(cells)]
+    first = EPOCH + timestamps[0] * SECOND
+    # the offset to local time of the first row, a DST change shifts the buckets
+    offset = local_delta(first) / SECOND
+    keys = np.floor((timestamps + offset) / width).astype(np.int64)
+    bounds = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    result = {}
+    for channel in channels:
+        if channel in CHANNELS:
+            values = frame[channel]
+            rollups = {
+                "minimum": frame.get(f"{channel}_min"),
+                "maximum": frame.get(f"{channel}_max"),
+                "samples": frame.get(f"{channel}_samples"),
+            }
+        elif channel.startswith("cell_") and channel[5:].isdigit():
+            cell = int(channel[5:])
+            if cell >= cells:
+                raise ValueError(f"Unbekannter Kanal {channel}")
+            values = frame["cells"][:, cell]
+            rollups = {}
+        else:
+            raise ValueError(f"Unbekannter Kanal {channel}")
+        counts = np.add.reduceat((~np.isnan(values)).astype(np.int64), bounds)
+        result[channel] = {
+            name: [
+                None if np.isnan(value) else float(value)
+                for value in _reduce(name, values, bounds, counts, **rollups)
+            ]
+            for name in statistics
+        }
+    return {
+        "width": width,
+        "timestamp": [
+            (EPOCH + int(key) * width * SECOND).isoformat() for key in keys[bounds]
+        ],
+        "channels": result,
+    }
+
+
+def query(
+    session: Session,
+    width: int,
+    channels: List[str],
+    statistics: List[str],
+    cycle: Optional[int],
+    start: Optional[datetime.datetime],
+    end: Optional[datetime.datetime],
+) -> dict:
+    """
+    Kennzahlen eines Zyklus oder aller Zyklen von start bis end.
+    """
+    if cycle is not None:
+        cycles = [cycle]
+    else:
+        cycles = get_cycles_in_range(session, start, end)
+    cells = any(channel.startswith("cell") for channel in channels)
+    columns = columns_for(channels, statistics)
+    frame = load(session, cycles, start, end, columns, cells)
+    return aggregate(frame, width, channels, statistics)
@@ -20,22 +20,42 @@ from fastapi.openapi.docs import (
 )
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
 from starlette.requests import Request
-from starlette.responses import FileResponse, RedirectResponse, StreamingResponse
+from starlette.responses import (
+    FileResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.templating import Jinja2Templates
 
+import aggregation
+import archive
+import backup
+import balance
 import current_values
 import database
 import dev_password
+import energy
+import errors
+import export_cache
+import health
+import histograms
 import ispdb
+import journal
 import nodes
 import notify
+import offload
 import scan_wlan
 import setapname
 import statistiken
 import update
 import wlanpw
 import wpa_passphrase
+import writes
 
 TZ_FILE = Path("/etc/timezone")
 LOGO = Path("/media/data/logo.png")
@@ -43,7 +63,7 @@ SCRIPT_PATH = Path(__file__).absolute().parent
 DATA_PATH = Path("/media/data")
 DEVELOPER_MODE = False
 
-session = database.Session()
+session = database.ReadSession()
 global_hostname = setapname.get_hostname()
 templates = Jinja2Templates(directory="templates")
 dev_settings_file = Path("/media/data/settings.json")
@@ -56,12 +76,50 @@ app = FastAPI(
     redoc_url=None,
 )
 
+
+class PrecompressedGZipResponder(GZipResponder):
+    """
+    Antworten mit Content-Encoding oder einem komprimierten Format
+    werden unverändert weitergegeben.
+    """
+
+    passthrough = False
+    compressed_types = ("application/zip", "application/gzip")
+
+    async def send_with_gzip(self, message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.passthrough = (
+                "content-encoding" in headers
+                or headers.get("content-type") in self.compressed_types
+            )
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
+
+
+class PrecompressedGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            if "gzip" in headers.get("Accept-Encoding", ""):
+                responder = PrecompressedGZipResponder(self.app, self.minimum_size)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+# the exports are much smaller compressed over the hotspot
+app.add_middleware(PrecompressedGZipMiddleware, minimum_size=1000)
+statistics_cache = export_cache.ExportCache()
+
 security = HTTPBasic()
 
 
 def update_settings(new_settings: dict):
     settings.update(new_settings)
-    dev_settings_file.write_text(json.dumps(settings))
+    writes.write_text(dev_settings_file, json.dumps(settings), writes.SETTINGS)
     node_server.update_settings(settings)
 
 
@@ -110,6 +168,10 @@ class CurrentValues(BaseModel):
     )
     lower_cell_voltage: float = Field(None, title="Untere Zellspannung")
     upper_cell_voltage: float = Field(None, title="Obere Zellspannung")
+    ah_in: float = Field(None, title="Geladen", description="Geladene Ah im Zyklus")
+    ah_out: float = Field(None, title="Entladen", description="Entladene Ah im Zyklus")
+    wh_in: float = Field(None, title="Geladen", description="Geladene Wh im Zyklus")
+    wh_out: float = Field(None, title="Entladen", description="Entladene Wh im Zyklus")
     hostname: str = Field(None, title="Gerätename")
 
 
@@ -120,6 +182,116 @@ class Error(BaseModel):
     error: int = Field(..., title="Fehlercode", description="Fehlercode dezimal")
 
 
+class CycleInfo(BaseModel):
+    cycle: int = Field(..., title="Zyklus", description="Zyklus")
+    start: datetime = Field(None, title="Start", description="Erster Datensatz UTC0")
+    end: datetime = Field(None, title="Ende", description="Letzter Datensatz UTC0")
+    rows: int = Field(..., title="Zeilen", description="Anzahl der Datensätze")
+    voltage_min: float = Field(None, title="Minimale Spannung in V")
+    voltage_max: float = Field(None, title="Maximale Spannung in V")
+    voltage_mean: float = Field(None, title="Mittlere Spannung in V")
+    current_min: float = Field(None, title="Minimaler Strom in A")
+    current_max: float = Field(None, title="Maximaler Strom in A")
+    current_mean: float = Field(None, title="Mittlerer Strom in A")
+    charge_min: float = Field(None, title="Minimale Ladung in Ah")
+    charge_max: float = Field(None, title="Maximale Ladung in Ah")
+    charge_mean: float = Field(None, title="Mittlere Ladung in Ah")
+    temperature_min: float = Field(None, title="Minimale Temperatur in °C")
+    temperature_max: float = Field(None, title="Maximale Temperatur in °C")
+    temperature_mean: float = Field(None, title="Mittlere Temperatur in °C")
+    ah_in: float = Field(None, title="Geladen", description="Geladene Ah")
+    ah_out: float = Field(None, title="Entladen", description="Entladene Ah")
+    errors: int = Field(None, title="Fehler", description="Anzahl der Fehlermeldungen")
+
+    class Config:
+        orm_mode = True
+
+
+class HealthInfo(BaseModel):
+    cycle: int = Field(..., title="Zyklus", description="Zyklus")
+    end: datetime = Field(None, title="Ende", description="Letzter Datensatz UTC0")
+    capacity: float = Field(None, title="Kapazität in Ah", description="Vom BMS")
+    capacity_estimate: float = Field(
+        None, title="Geschätzte Kapazität in Ah", description="Aus dem Strom"
+    )
+    resistance: float = Field(None, title="Innenwiderstand in Ohm")
+    resistance_steps: int = Field(
+        0, title="Stromsprünge", description="Anzahl der Messungen des Widerstands"
+    )
+    efficiency: float = Field(None, title="Coulomb-Wirkungsgrad")
+
+    class Config:
+        orm_mode = True
+
+
+class HealthReport(BaseModel):
+    cycles: List[HealthInfo]
+    capacity_per_100_cycles: float = Field(
+        None, title="Änderung der Kapazität in Ah je 100 Zyklen"
+    )
+    resistance_per_100_cycles: float = Field(
+        None, title="Änderung des Innenwiderstands in Ohm je 100 Zyklen"
+    )
+    state_of_health: float = Field(
+        None,
+        title="Zustand",
+        description="Letzte geschätzte Kapazität im Verhältnis zur ersten "
+        "gemeldeten, ohne genug Schätzungen leer",
+    )
+
+
+class BalanceInfo(BaseModel):
+    cycle: int = Field(..., title="Zyklus", description="Zyklus")
+    end: datetime = Field(None, title="Ende", description="Letzter Datensatz UTC0")
+    rows: int = Field(0, title="Zeilen", description="Datensätze mit allen Zellen")
+    spread_mean: float = Field(None, title="Mittlere Spreizung in V")
+    spread_max: float = Field(None, title="Maximale Spreizung in V")
+    spread_histogram: List[int] = Field(
+        [], title="Histogramm", description="Datensätze je 5 mV Spreizung"
+    )
+    deviations: List[float] = Field(
+        [], title="Abweichung in V", description="Je Zelle vom Mittelwert der Zellen"
+    )
+    lower_counts: List[int] = Field([], title="Wie oft jede Zelle die niedrigste war")
+    upper_counts: List[int] = Field([], title="Wie oft jede Zelle die höchste war")
+    drifting_cell: int = Field(None, title="Driftende Zelle", description="Index")
+
+    class Config:
+        orm_mode = True
+
+
+class BalanceReport(BaseModel):
+    cycles: List[BalanceInfo]
+    spread_bin: float = Field(..., title="Breite der Klassen in V")
+    drift_per_100_cycles: List[float] = Field(
+        [], title="Änderung der Abweichung jeder Zelle in V je 100 Zyklen"
+    )
+
+
+class CaptureInfo(BaseModel):
+    id: int = Field(..., title="Aufzeichnung", description="Nummer der Aufzeichnung")
+    cycle: int = Field(..., title="Zyklus", description="Zyklus")
+    row: int = Field(..., title="Zeile", description="Datensatz beim Auslösen")
+    reason: str = Field(..., title="Auslöser", description="Fehler oder Grenzwert")
+    trigger_timestamp: datetime = Field(
+        ..., title="Auslösezeit", description="Zeitpunkt des Auslösers UTC0"
+    )
+    start: datetime = Field(None, title="Start", description="Erster Messwert UTC0")
+    end: datetime = Field(None, title="Ende", description="Letzter Messwert UTC0")
+    samples: int = Field(..., title="Messwerte", description="Anzahl der Messwerte")
+
+    class Config:
+        orm_mode = True
+
+
+class CaptureData(CaptureInfo):
+    data: dict = Field(
+        ...,
+        title="Messwerte",
+        description="Je Kanal die Sekunden relativ zum Auslöser (t) und die Werte (v)",
+    )
+
+
 class Wlan(BaseModel):
     ssid: str
     password: str
@@ -266,6 +438,7 @@ async def dev_settings_post(
         with LOGO.open("wb") as logo_disk:
             data = await upload_logo.read()
             await loop.run_in_executor(executor, logo_disk.write, data)
+        writes.account(writes.SETTINGS, len(data))
 
     settings["without_charge"] = bool(without_charge.strip())
     settings["without_current"] = bool(without_current.strip())
@@ -409,20 +582,524 @@ async def dev_settings_post(
     )
 
 
+# long-poll of /api/statistics in seconds
+STATISTICS_POLL_INTERVAL = 1.0
+STATISTICS_MAX_WAIT = 60.0
+# seconds to wait for server.py to flush the journal before a backup
+JOURNAL_FLUSH_TIMEOUT = 10.0
+# format: (function, media type, file name for download)
+STATISTICS_FORMATS = {
+    "csv": (statistiken.get_stats, "text/csv", "stats.csv"),
+    "json": (statistiken.get_stats_columns, "application/json", None),
+    "ndjson": (statistiken.get_stats_ndjson, "application/x-ndjson", None),
+    "bin": (statistiken.get_stats_binary, "application/octet-stream", "stats.bin"),
+}
+
+
+def statistics_format(request: Request, format: Optional[str]) -> str:
+    """
+    Format aus dem Parameter format oder dem Header Accept.
+    """
+    if format is not None:
+        if format not in STATISTICS_FORMATS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unbekanntes Format {format}",
+            )
+        return format
+    accept = request.headers.get("accept", "")
+    for name, (_, media_type, _) in STATISTICS_FORMATS.items():
+        if media_type in accept:
+            return name
+    return "csv"
+
+
+def statistics_key(name: str, parameters: dict) -> str:
+    return export_cache.cache_key(
+        parameters["cycle"],
+        name,
+        parameters["rounding"],
+        parameters["points"],
+        statistiken.tz,
+    )
+
+
+def put_statistics_entry(name: str, parameters: dict) -> export_cache.Entry:
+    """
+    Export eines abgeschlossenen Zyklus erzeugen und speichern.
+
+    Der Export läuft in einem Kindprozess, ein Platz muss mit
+    offload.slot() belegt sein.
+    """
+    statistics_cache.size_limit = int(settings.get("export_cache_mb", 20) * 1024 ** 2)
+    function = STATISTICS_FORMATS[name][0]
+    return statistics_cache.put(
+        statistics_key(name, parameters), offload.iterate(function, **parameters)
+    )
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+async def wait_for_row(
+    request: Request, cycle: int, since_row: Optional[int], wait: Optional[float]
+) -> Optional[int]:
+    """
+    Letzte gespeicherte Zeile des Zyklus.
+
+    Mit wait und since_row wird gewartet, bis eine neuere Zeile
+    gespeichert ist. Die Datenbank wird nur abgefragt, nachdem
+    server.py das Journal geschrieben hat.
+    """
+    next_row = await loop.run_in_executor(
+        executor, statistiken.last_row, session, cycle
+    )
+    if not wait or since_row is None:
+        return next_row
+    deadline = time.monotonic() + min(wait, STATISTICS_MAX_WAIT)
+    flushed = journal.last_flush()
+    while (next_row is None or next_row <= since_row) and time.monotonic() < deadline:
+        await asyncio.sleep(STATISTICS_POLL_INTERVAL)
+        if await request.is_disconnected():
+            break
+        if journal.last_flush() == flushed:
+            continue
+        flushed = journal.last_flush()
+        next_row = await loop.run_in_executor(
+            executor, statistiken.last_row, session, cycle
+        )
+    return next_row
+
+
 @app.get("/api/statistics")
 async def async_statistics(
-    cycle: int, history: float = None, rounding: Optional[int] = None
+    request: Request,
+    cycle: Optional[int] = None,
+    history: float = None,
+    rounding: Optional[int] = None,
+    format: Optional[str] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    since_ts: Optional[datetime] = None,
+    wait: Optional[float] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
 ):
     """
-    Statistiken eines Zyklus als csv Datei herunterladen.
+    Statistiken eines Zyklus oder eines Zeitraums herunterladen.
+
+    format ist csv (Standard), json (Spalten für c3), ndjson oder bin
+    (float32, siehe statistiken.get_stats_binary). Ohne format wird
+    das Format aus dem Header Accept bestimmt.
+    Mit points werden Spannung, Strom, Ladung und Temperatur mit LTTB
+    auf höchstens points Punkte je Kanal reduziert.
+    Abgeschlossene Zyklen ohne history werden einmal komprimiert
+    gespeichert und mit ETag ausgeliefert.
+
+    Für den laufenden Zyklus enthält der Header X-Next-Row die Nummer
+    der letzten gelieferten Zeile. Mit since_row=X-Next-Row werden beim
+    nächsten Abruf nur neuere Zeilen geliefert, since_ts (ohne Zeitzone
+    in Ortszeit) liefert die Zeilen nach dem Zeitstempel. Mit wait
+    wartet die Anfrage bis zu wait Sekunden (höchstens 60), bis eine
+    Zeile nach since_row gespeichert ist.
+
+    Ohne cycle werden alle Zyklen von start bis end (ohne Zeitzone in
+    Ortszeit, end ist standardmäßig jetzt) nach der Zeit zusammengeführt,
+    die zusätzliche Spalte cycle markiert die Grenzen der Zyklen.
     """
-    headers = {"Content-Disposition": 'attachment; filename="stats.csv"'}
+    if cycle is None and start is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="cycle oder start angeben",
+        )
+    if points is not None and points < 3:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="points muss mindestens 3 sein",
+        )
+    name = statistics_format(request, format)
+    function, media_type, filename = STATISTICS_FORMATS[name]
+    headers = {}
+    if filename is not None:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    # the export runs in a child process with an own session
+    parameters = {
+        "cycle": cycle,
+        "history": history,
+        "rounding": rounding,
+        "points": points,
+        "since_row": since_row,
+        "since_ts": statistiken.parse_since(since_ts) if since_ts else None,
+    }
+    if cycle is None:
+        parameters["start"] = statistiken.parse_since(start)
+        parameters["end"] = statistiken.parse_since(end) if end else datetime.utcnow()
+        return StreamingResponse(
+            offload.stream(function, **parameters),
+            headers=headers,
+            media_type=media_type,
+        )
+    current_cycle = await loop.run_in_executor(executor, database.get_cycle, session)
+    if cycle >= current_cycle:
+        # the running cycle changes with every row
+        next_row = await wait_for_row(request, cycle, since_row, wait)
+        if next_row is None:
+            next_row = -1 if since_row is None else since_row
+        # rows stored while streaming belong to the next request
+        parameters["until_row"] = next_row
+        headers["X-Next-Row"] = str(next_row)
+        return StreamingResponse(
+            offload.stream(function, **parameters),
+            headers=headers,
+            media_type=media_type,
+        )
+    if history is not None or since_row is not None or since_ts is not None:
+        return StreamingResponse(
+            offload.stream(function, **parameters),
+            headers=headers,
+            media_type=media_type,
+        )
+    entry = statistics_cache.get(statistics_key(name, parameters))
+    if entry is None:
+        async with offload.slot():
+            entry = await loop.run_in_executor(
+                executor, put_statistics_entry, name, parameters
+            )
+    compressed = "gzip" in request.headers.get("accept-encoding", "")
+    # each encoding is an own representation
+    etag = f'"{entry.etag}-gzip"' if compressed else f'"{entry.etag}"'
+    headers.update(
+        {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    )
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(entry.path, headers=headers, media_type=media_type)
     return StreamingResponse(
-        statistiken.get_stats(
-            session=session, cycle=cycle, history=history, rounding=rounding
-        ),
+        export_cache.iter_decompressed(entry.path),
         headers=headers,
-        media_type="text/csv",
+        media_type=media_type,
+    )
+
+
+@app.get("/api/aggregate")
+async def aggregate(
+    width: str = "1h",
+    channels: str = "voltage,current,charge,temperature",
+    statistics: str = "min,max,mean",
+    cycle: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Kennzahlen der Statistik je Intervall.
+
+    width ist die Breite der Intervalle (z. B. 900, 15m, 1h, 1d).
+    channels und statistics sind mit Komma getrennt, die Kanäle sind
+    voltage, current, charge, temperature, cell_0, ... oder cells,
+    die Kennzahlen count, samples, min, max, mean, std und Perzentile
+    wie p95. Ausgewertet wird ein Zyklus oder der Zeitraum von start
+    bis end (ohne Zeitzone in Ortszeit, end ist standardmäßig jetzt).
+    """
+    if cycle is None and start is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="cycle oder start angeben",
+        )
+    try:
+        width_seconds = aggregation.parse_width(width)
+        names = aggregation.parse_statistics(statistics.split(","))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    start = statistiken.parse_since(start) if start else None
+    if end is not None:
+        end = statistiken.parse_since(end)
+    elif cycle is None:
+        end = datetime.utcnow()
+    try:
+        return await offload.run(
+            aggregation.query,
+            width_seconds,
+            channels.split(","),
+            names,
+            cycle,
+            start,
+            end,
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+
+async def flush_journal(timeout: float = JOURNAL_FLUSH_TIMEOUT) -> bool:
+    """
+    Journal von server.py in die Datenbank schreiben lassen.
+
+    Gibt False zurück, wenn das Journal nicht innerhalb von timeout
+    Sekunden geschrieben wurde.
+    """
+    flushed = journal.last_flush()
+    control.send_multipart([b"CONTROL", b"flush"])
+    deadline = time.monotonic() + timeout
+    while journal.last_flush() == flushed:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(STATISTICS_POLL_INTERVAL)
+    return True
+
+
+@app.get("/api/backup")
+async def database_backup():
+    """
+    Konsistente Sicherung aller Daten als ZIP-Archiv herunterladen.
+
+    Das Archiv enthält die Datenbank stats.sqlite, die versiegelten
+    Partitionen und ihren Index wie unter /media/data. Vorher wird das
+    Journal gespeichert, die Erfassung läuft während der Sicherung weiter.
+    """
+    # without a running server.py the data of the last flush is saved
+    await flush_journal()
+    path = await loop.run_in_executor(executor, backup.snapshot)
+    filename = f"{global_hostname}-backup-{datetime.now():%Y%m%d-%H%M%S}.zip"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    return StreamingResponse(
+        backup.iter_backup(path),
+        headers=headers,
+        media_type="application/zip",
+        # also after the client has disconnected
+        background=BackgroundTask(backup.remove, path),
+    )
+
+
+@app.get("/api/export/all")
+async def export_all(rounding: Optional[int] = None):
+    """
+    Alle Zyklen, die Tabellen error, error_event, state, configuration,
+    cycle_health, cell_balance und cycle_histogram und die Einstellungen
+    als ZIP-Archiv herunterladen.
+
+    Das Archiv wird beim Senden erzeugt, siehe archive.py.
+    """
+    filename = f"{global_hostname}-{datetime.now():%Y%m%d-%H%M%S}.zip"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    return StreamingResponse(
+        offload.stream(archive.iter_archive, settings, rounding),
+        headers=headers,
+        media_type="application/zip",
+    )
+
+
+def get_writes() -> dict:
+    budget = settings.get("write_budget_mb")
+    budget_bytes = budget * 1024 ** 2 if budget else None
+    return {
+        "days": writes.totals(),
+        "budget_mb": budget,
+        "stretch": writes.stretch_factor(budget_bytes),
+    }
+
+
+@app.get("/api/writes")
+async def sd_writes():
+    """
+    Geschriebene Bytes und Synchronisierungen je Tag und Subsystem,
+    das Schreibbudget in MiB pro Tag und der aktuelle Faktor,
+    um den die Intervalle zum Speichern gestreckt werden.
+    """
+    return await loop.run_in_executor(executor, get_writes)
+
+
+@app.get("/api/captures", response_model=List[CaptureInfo])
+async def captures(
+    cycle: Optional[int] = None, before: Optional[int] = None, limit: int = 50
+):
+    """
+    Aufzeichnungen mit hoher Auflösung, die neuesten zuerst.
+
+    Mit before werden nur Aufzeichnungen vor dieser Nummer geliefert.
+    """
+    return await loop.run_in_executor(
+        executor, database.get_captures, session, cycle, before, min(limit, 1000)
+    )
+
+
+@app.get("/api/captures/{capture_id}", response_model=CaptureData)
+async def capture_data(capture_id: int):
+    """
+    Aufzeichnung mit allen Messwerten.
+    """
+    result = await loop.run_in_executor(
+        executor, database.get_capture, session, capture_id
+    )
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Aufzeichnung {capture_id} nicht gefunden",
+        )
+    return result
+
+
+@app.get("/api/cycles", response_model=List[CycleInfo])
+async def cycles(limit: int = 50, before: Optional[int] = None):
+    """
+    Katalog der Zyklen, die neuesten zuerst.
+
+    Mit before werden nur Zyklen vor diesem Zyklus geliefert.
+    """
+    return await loop.run_in_executor(
+        executor, database.get_cycle_summaries, session, limit, before
+    )
+
+
+def get_health(limit: int, before: Optional[int]) -> dict:
+    rows = database.get_health(session, limit, before)
+    initial = database.get_initial_capacity(session)
+    return {"cycles": rows, **health.trend(rows, initial)}
+
+
+@app.get("/api/health", response_model=HealthReport)
+async def state_of_health(limit: int = 100, before: Optional[int] = None):
+    """
+    Zustand des Akkus je Zyklus, die neuesten zuerst, und die Entwicklung
+    von Kapazität und Innenwiderstand über diese Zyklen.
+
+    Die Kennwerte werden beim Speichern fortgeschrieben, siehe health.py.
+    """
+    return await loop.run_in_executor(executor, get_health, min(limit, 1000), before)
+
+
+def get_balance(limit: int, before: Optional[int]) -> dict:
+    rows = database.get_balance(session, limit, before)
+    return {
+        "cycles": rows,
+        "spread_bin": balance.SPREAD_BIN,
+        "drift_per_100_cycles": balance.drift(rows),
+    }
+
+
+@app.get("/api/balance", response_model=BalanceReport)
+async def cell_balance(limit: int = 100, before: Optional[int] = None):
+    """
+    Ungleichgewicht der Zellen je Zyklus, die neuesten zuerst.
+
+    drifting_cell ist die Zelle, die im Zyklus deutlich und fast immer
+    die niedrigste oder höchste war, siehe balance.py.
+    """
+    return await loop.run_in_executor(executor, get_balance, min(limit, 1000), before)
+
+
+def get_histograms(
+    cycle: Optional[int], start: Optional[datetime], end: Optional[datetime]
+) -> dict:
+    if cycle is not None:
+        cycles = [cycle]
+    elif start is not None:
+        cycles = database.get_cycles_in_range(session, start, end)
+    else:
+        row = database.get_histogram(session, database.LIFETIME)
+        result = histograms.merge([row] if row is not None else [])
+        result["cycles"] = None
+        return result
+    return histograms.merge(database.get_histograms(session, cycles))
+
+
+@app.get("/api/histograms")
+async def value_histograms(
+    cycle: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Sekunden je Klasse von Ladezustand (soc in %), Temperatur (°C)
+    und C-Rate (Strom durch Kapazität, positiv beim Laden).
+
+    Ohne Parameter für die Lebensdauer, sonst für einen Zyklus oder alle
+    Zyklen, die zwischen start und end (ohne Zeitzone in Ortszeit, end
+    ist standardmäßig jetzt) liegen, jeweils ganz. edges sind die Grenzen
+    der Klassen, die erste und letzte Klasse enthalten auch alle Werte
+    außerhalb.
+    """
+    if start is not None:
+        start = statistiken.parse_since(start)
+        end = statistiken.parse_since(end) if end else datetime.utcnow()
+    return await loop.run_in_executor(executor, get_histograms, cycle, start, end)
+
+
+def get_energy(cycle: Optional[int]) -> dict:
+    values = current_values.get_values()
+    capacity = values.get("capacity")
+    # the running cycle is newer as the database
+    lifetime = energy.Throughput(
+        values.get("lifetime_ah_in", 0.0),
+        values.get("lifetime_ah_out", 0.0),
+        values.get("lifetime_wh_in", 0.0),
+        values.get("lifetime_wh_out", 0.0),
+    )
+    if cycle is None or cycle == values.get("cycle"):
+        cycle = values.get("cycle")
+        cycle_throughput = energy.Throughput(
+            values.get("ah_in", 0.0),
+            values.get("ah_out", 0.0),
+            values.get("wh_in", 0.0),
+            values.get("wh_out", 0.0),
+        )
+    else:
+        cycle_throughput = energy.Throughput.from_row(
+            database.get_energy(session, cycle)
+        )
+    return {
+        "cycle": cycle,
+        "capacity": capacity,
+        "cycle_throughput": energy.kpis(cycle_throughput, capacity),
+        "lifetime": energy.kpis(lifetime, capacity),
+    }
+
+
+@app.get("/api/energy")
+async def energy_counters(cycle: Optional[int] = None):
+    """
+    Geladene und entladene Ah und Wh des Zyklus und der Lebensdauer,
+    äquivalente Vollzyklen und Wirkungsgrad.
+
+    Ohne cycle wird der laufende Zyklus geliefert.
+    """
+    return await loop.run_in_executor(executor, get_energy, cycle)
+
+
+@app.get("/api/errors")
+async def error_history(
+    bit: Optional[str] = None,
+    cycle: Optional[int] = None,
+    cursor: Optional[int] = None,
+    limit: int = 100,
+):
+    """
+    Fehlerhistorie, die neuesten Ereignisse zuerst.
+
+    bit ist der Fehlercode (z.B. 0x4000) oder der Name (eError_OverTemp).
+    Für die nächste Seite wird next_cursor als cursor übergeben.
+    """
+    error_bit = None
+    if bit is not None:
+        names = {error.header: eid for eid, error in errors.error_mapping.items()}
+        try:
+            error_bit = names[bit] if bit in names else int(bit, 0)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unbekannter Fehlercode {bit}",
+            )
+    return await loop.run_in_executor(
+        executor,
+        statistiken.get_errors,
+        session,
+        error_bit,
+        cycle,
+        cursor,
+        min(limit, 1000),
     )
 
 
@@ -467,11 +1144,15 @@ def live():
 async def graph(request: Request):
     async with graph_busy:
         cycle = await loop.run_in_executor(executor, database.get_cycle, session)
+        cycles = await loop.run_in_executor(
+            executor, database.get_cycle_summaries, session, 100
+        )
     return templates.TemplateResponse(
         "statistik.html",
         {
             "request": request,
             "cycle": cycle,
+            "cycles": cycles,
             "history": 2,
         },
     )
@@ -479,11 +1160,16 @@ async def graph(request: Request):
 
 @app.post("/graph")
 async def graph(request: Request, cycle: int = Form(...), history: float = Form(...)):
+    async with graph_busy:
+        cycles = await loop.run_in_executor(
+            executor, database.get_cycle_summaries, session, 100
+        )
     return templates.TemplateResponse(
         "statistik.html",
         {
             "request": request,
             "cycle": cycle,
+            "cycles": cycles,
             "history": history,
         },
     )
@@ -703,9 +1389,9 @@ async def set_wlan(
         success = "SSID und Passwort sind erfolgreich gesetzt worden."
         wifi_mode_config = Path("/media/data/wifi_mode")
         if client_mode:
-            wifi_mode_config.write_text("wlan0\n")
+            writes.write_text(wifi_mode_config, "wlan0\n")
         else:
-            wifi_mode_config.write_text("ap0\n")
+            writes.write_text(wifi_mode_config, "ap0\n")
     return templates.TemplateResponse(
         "internet.html",
         {
@@ -762,7 +1448,8 @@ async def post_email(
         if email_smtp_port == 0:
             email_smtp_port = smtp_settings["email_smtp_port"]
         email_smtp_ssl = smtp_settings["email_smtp_ssl"]
-    Path("/media/data/email.json").write_text(
+    writes.write_text(
+        Path("/media/data/email.json"),
         json.dumps(
             {
                 "email_from": email_from,
@@ -773,7 +1460,8 @@ async def post_email(
                 "email_smtp_port": email_smtp_port,
                 "email_smtp_ssl": email_smtp_ssl,
             }
-        )
+        ),
+        writes.SETTINGS,
     )
     return templates.TemplateResponse(
         "email.html",
@@ -912,7 +1600,7 @@ def _set_time(date_iso: str, time_iso: str, timezone: str):
     dt_str = f"{date_iso}T{time_iso}"
     with read_write_mode():
         call(["date", "+%Y-%m-%dT%H%M%SS", "-s", dt_str])
-        TZ_FILE.write_text(timezone + "\n")
+        writes.write_text(TZ_FILE, timezone + "\n")
 
 
 if __name__ in ("__main__", "api"):
@@ -963,8 +1651,10 @@ if __name__ in ("__main__", "api"):
             raise ValueError
     except (FileNotFoundError, ValueError):
         settings = settings_default.copy()
-        dev_settings_file.write_text(json.dumps(settings))
+        writes.write_text(dev_settings_file, json.dumps(settings), writes.SETTINGS)
     update_settings(settings)
+    # exports and aggregations run in child processes
+    offload.start(settings.get("offload_jobs", offload.MAX_JOBS))
     node_server.start()
     loop = asyncio.get_event_loop()
     loop.create_task(reboot_watchdog())
@@ -0,0 +1,184 @@
+"""
+Export aller Zyklen als ZIP-Archiv in einem Abruf.
+
+Das Archiv wird beim Senden erzeugt. zipfile schreibt in einen Puffer
+ohne seek, der nach jedem Block geleert wird, die Größen stehen deshalb
+in Data Descriptors hinter den Dateien. Es entstehen keine temporären
+Dateien und der Speicherbedarf ist durch CHUNK_SIZE begrenzt.
+
+Inhalt:
+- cycle-<n>.csv je Zyklus wie bei /api/statistics (Ortszeit)
+- error.csv, error_event.csv, state.csv, configuration.csv,
+  cycle_health.csv, cell_balance.csv und cycle_histogram.csv aus der
+  Datenbank und den versiegelten Partitionen (Zeitstempel in UTC)
+- settings.json ohne Passwörter
+"""
+import csv
+import io
+import json
+import time
+import zipfile
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Union
+
+from sqlalchemy.exc import OperationalError
+
+import dal
+import partitions
+import statistiken
+from database import DB_PATH, Session, Statistik, get_all_cycles, get_session
+
+CHUNK_SIZE = 64 * 1024
+COMPRESS_LEVEL = 6
+ROWS = 1000
+TABLES = (
+    "error",
+    "error_event",
+    "state",
+    "configuration",
+    "cycle_health",
+    "cell_balance",
+    "cycle_histogram",
+)
+# werden beim Versiegeln in die neue Datenbank übernommen
+CARRIED_OVER = ("error_event", "cycle_health", "cell_balance", "cycle_histogram")
+
+
+class Buffer:
+    """
+    Ziel für zipfile, das nur geschrieben und blockweise geleert wird.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def _paths(table: str) -> List[Path]:
+    if table in CARRIED_OVER:
+        return [DB_PATH]
+    sealed = [partitions.partition_file(entry) for entry in partitions.load_index()]
+    return [path for path in sealed if path.exists()] + [DB_PATH]
+
+
+def iter_table(table: str) -> Iterator[str]:
+    """
+    Alle Zeilen einer Tabelle als CSV, die ältesten zuerst.
+
+    Fehlt eine Spalte in einer älteren Datei, bleibt sie leer.
+    """
+    with closing(dal.connect(DB_PATH, read_only=True)) as connection:
+        columns = dal.table_columns(connection, table)
+    if not columns:
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for path in _paths(table):
+        with closing(dal.connect(path, read_only=True)) as connection:
+            existing = set(dal.table_columns(connection, table))
+            if not existing:
+                continue
+            selected = ", ".join(
+                column if column in existing else "NULL" for column in columns
+            )
+            # rowid is the id or the cycle of the tables with one row per cycle
+            cursor = connection.execute(
+                f"SELECT {selected} FROM {table} ORDER BY rowid"
+            )
+            while True:
+                rows = cursor.fetchmany(ROWS)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_entry(
+    archive: zipfile.ZipFile,
+    buffer: Buffer,
+    name: str,
+    chunks: Iterable[Union[str, bytes]],
+    compress_type: int = zipfile.ZIP_DEFLATED,
+) -> Iterator[bytes]:
+    """
+    Datei name aus den Blöcken chunks in das Archiv schreiben
+    und den Inhalt von buffer blockweise zurückgeben.
+    """
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    # the size is not known before, entries above 2 GiB need zip64
+    with archive.open(info, "w", force_zip64=True) as file:
+        for chunk in chunks:
+            file.write(chunk.encode() if isinstance(chunk, str) else chunk)
+            if buffer.size >= CHUNK_SIZE:
+                yield buffer.take()
+    if buffer.size:
+        yield buffer.take()
+
+
+def _all_cycles(session: Session) -> List[int]:
+    """
+    Zyklen der Datenbank und aller versiegelten Partitionen.
+    """
+    cycles = set(get_all_cycles(session))
+    for entry in partitions.load_index():
+        with get_session(session, entry["first_cycle"]) as partition_session:
+            try:
+                cycles.update(get_all_cycles(partition_session))
+            except OperationalError:
+                # Partition von vor dem Katalog und der Komprimierung
+                cycles.update(
+                    row[0]
+                    for row in partition_session.query(Statistik.cycle).distinct()
+                )
+    return sorted(cycles)
+
+
+def iter_archive(
+    session: Session, settings: Optional[dict] = None, rounding: Optional[int] = None
+) -> Iterator[bytes]:
+    """
+    ZIP-Archiv mit allen Zyklen, Tabellen und Einstellungen in Blöcken.
+    """
+    buffer = Buffer()
+    with zipfile.ZipFile(
+        buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL
+    ) as archive:
+        last_sealed = partitions.last_cycle()
+        for cycle in _all_cycles(session):
+            if cycle <= last_sealed and partitions.find(cycle) is None:
+                # die Partition wurde gelöscht, nur der Katalog ist übrig
+                continue
+            chunks = statistiken.get_stats(session, cycle, rounding=rounding)
+            yield from write_entry(archive, buffer, f"cycle-{cycle}.csv", chunks)
+        for table in TABLES:
+            yield from write_entry(archive, buffer, f"{table}.csv", iter_table(table))
+        if settings is not None:
+            public = {
+                key: value for key, value in settings.items() if "password" not in key
+            }
+            yield from write_entry(
+                archive, buffer, "settings.json", [json.dumps(public, indent=2)]
+            )
+    # central directory
+    yield buffer.take()
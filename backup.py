@@ -0,0 +1,136 @@
+"""
+Online-Sicherung der Datenbank.
+
+Die Sicherung verwendet die Backup-API von SQLite und kopiert
+wenige Seiten je Schritt. Zwischen den Schritten kann server.py
+weiter schreiben, ohne dass die Erfassung angehalten wird.
+Ändert sich die Datenbank während der Sicherung, beginnt SQLite
+von vorn, die Kopie ist also immer konsistent.
+
+Zum Herunterladen wird die Kopie mit dem Index und den versiegelten
+Partitionen in ein ZIP-Archiv gepackt, dessen Aufbau dem Verzeichnis
+/media/data entspricht.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Iterator, Union
+
+import archive
+import partitions
+from database import DB_PATH
+
+# tmpfs, damit die Kopie nicht zusätzlich auf die SD-Karte geschrieben wird
+SNAPSHOT_PATH = Path("/dev/shm")
+PAGES = 64
+PAUSE = 0.05
+CHUNK_SIZE = 64 * 1024
+
+
+def backup(
+    target: Union[str, Path],
+    source: Path = DB_PATH,
+    pages: int = PAGES,
+    pause: float = PAUSE,
+) -> Path:
+    """
+    Datenbank nach target sichern.
+
+    Es werden pages Seiten je Schritt kopiert und danach pause Sekunden
+    gewartet, damit die SD-Karte nicht ausgelastet wird.
+    """
+    target = Path(target)
+    source_connection = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    target_connection = sqlite3.connect(str(target))
+    try:
+        source_connection.backup(target_connection, pages=pages, sleep=pause)
+    finally:
+        target_connection.close()
+        source_connection.close()
+    return target
+
+
+def snapshot(source: Path = DB_PATH, pages: int = PAGES, pause: float = PAUSE) -> Path:
+    """
+    Sicherung in eine temporäre Datei im tmpfs.
+    """
+    fd, name = tempfile.mkstemp(prefix="stats-", suffix=".sqlite", dir=SNAPSHOT_PATH)
+    # eine leere Datei ist für SQLite eine leere Datenbank
+    os.close(fd)
+    path = Path(name)
+    try:
+        return backup(path, source, pages, pause)
+    except Exception:
+        path.unlink()
+        raise
+
+
+def iter_file(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Datei in Blöcken lesen.
+    """
+    with path.open("rb") as fd:
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def remove(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def iter_backup(snapshot_path: Path) -> Iterator[bytes]:
+    """
+    ZIP-Archiv mit der Sicherung snapshot_path und allen Partitionen
+    in Blöcken.
+
+    Die Dateien von SQLite werden nicht komprimiert, das belegt
+    beim Herunterladen kaum Rechenzeit.
+    """
+    buffer = archive.Buffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as target:
+        yield from archive.write_entry(
+            target, buffer, DB_PATH.name, iter_file(snapshot_path), zipfile.ZIP_STORED
+        )
+        index = [
+            entry
+            for entry in partitions.load_index()
+            if partitions.partition_file(entry).exists()
+        ]
+        prefix = partitions.PARTITION_PATH.name
+        for entry in index:
+            yield from archive.write_entry(
+                target,
+                buffer,
+                f"{prefix}/{entry['file']}",
+                iter_file(partitions.partition_file(entry)),
+                zipfile.ZIP_STORED,
+            )
+        yield from archive.write_entry(
+            target,
+            buffer,
+            f"{prefix}/{partitions.INDEX_FILE.name}",
+            [json.dumps(index)],
+        )
+    # central directory
+    yield buffer.take()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Online-Sicherung der Datenbank")
+    parser.add_argument("target", type=Path, help="Zieldatei der Sicherung")
+    parser.add_argument("--pages", type=int, default=PAGES, help="Seiten je Schritt")
+    parser.add_argument(
+        "--pause", type=float, default=PAUSE, help="Pause zwischen den Schritten"
+    )
+    args = parser.parse_args()
+    backup(args.target, pages=args.pages, pause=args.pause)
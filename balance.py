@@ -0,0 +1,161 @@
+"""
+Ungleichgewicht der Zellen.
+
+Beim Speichern eines Datensatzes werden die Spreizung der Zellspannungen
+und die Zellen mit der niedrigsten und höchsten Spannung berechnet und
+mit der Zeile gespeichert. Je Zyklus werden ein Histogramm der Spreizung,
+die mittlere Abweichung jeder Zelle vom Mittelwert der Zellen und die
+Anzahl, wie oft eine Zelle die niedrigste oder höchste war, fortgeschrieben.
+
+Eine Zelle driftet, wenn ihre mittlere Abweichung mindestens DRIFT_LIMIT
+beträgt und sie in mindestens DRIFT_SHARE der Datensätze die niedrigste
+bzw. höchste Zelle war.
+"""
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from database import CellBalance, Session
+from health import slope
+from histograms import Histogram
+
+# Breite und Anzahl der Klassen des Histogramms der Spreizung in V,
+# die letzte Klasse enthält auch alle größeren Werte
+SPREAD_BIN = 0.005
+SPREAD_BINS = 40
+DRIFT_LIMIT = 0.015
+DRIFT_SHARE = 0.75
+
+
+def analyse(cell_voltages: Sequence[Optional[float]]) -> Optional[dict]:
+    """
+    Spreizung und Index der niedrigsten und höchsten Zelle eines Datensatzes.
+
+    Ohne gültige Spannungen aller Zellen wird None zurückgegeben.
+    """
+    if len(cell_voltages) < 2 or not all(cell_voltages):
+        return None
+    lower = min(range(len(cell_voltages)), key=cell_voltages.__getitem__)
+    upper = max(range(len(cell_voltages)), key=cell_voltages.__getitem__)
+    return {
+        "spread": cell_voltages[upper] - cell_voltages[lower],
+        "lower_cell": lower,
+        "upper_cell": upper,
+    }
+
+
+class BalanceTracker:
+    """
+    Laufende Auswertung des Ungleichgewichts eines Zyklus
+    """
+
+    def __init__(self, cycle: int):
+        self.cycle = cycle
+        self.end: Optional[datetime] = None
+        self.rows = 0
+        self.spread_sum = 0.0
+        self.spread_max: Optional[float] = None
+        self.histogram = Histogram(0.0, SPREAD_BIN, SPREAD_BINS)
+        self.deviation_sums: List[float] = []
+        self.lower_counts: List[int] = []
+        self.upper_counts: List[int] = []
+
+    def add(self, timestamp: datetime, cell_voltages: Sequence[float]) -> dict:
+        """
+        Zellspannungen eines Datensatzes hinzufügen.
+
+        Gibt die Spalten spread, lower_cell und upper_cell der Zeile zurück,
+        ohne gültige Spannungen sind sie None.
+        """
+        result = analyse(cell_voltages)
+        if result is None:
+            return dict.fromkeys(("spread", "lower_cell", "upper_cell"))
+        cells = len(cell_voltages)
+        if cells > len(self.deviation_sums):
+            missing = cells - len(self.deviation_sums)
+            self.deviation_sums += [0.0] * missing
+            self.lower_counts += [0] * missing
+            self.upper_counts += [0] * missing
+        mean = sum(cell_voltages) / cells
+        for cell, voltage in enumerate(cell_voltages):
+            self.deviation_sums[cell] += voltage - mean
+        spread = result["spread"]
+        self.histogram.add(spread)
+        self.spread_sum += spread
+        if self.spread_max is None or spread > self.spread_max:
+            self.spread_max = spread
+        self.lower_counts[result["lower_cell"]] += 1
+        self.upper_counts[result["upper_cell"]] += 1
+        self.rows += 1
+        self.end = timestamp
+        return result
+
+    def add_stored(self, row) -> None:
+        """
+        Gespeicherte Zeile der Tabelle statistik hinzufügen.
+        """
+        self.add(row.timestamp, row.cell_voltages or [])
+
+    @property
+    def deviations(self) -> List[float]:
+        if not self.rows:
+            return []
+        return [total / self.rows for total in self.deviation_sums]
+
+    @property
+    def drifting_cell(self) -> Optional[int]:
+        deviations = self.deviations
+        if not deviations:
+            return None
+        cell = max(range(len(deviations)), key=lambda index: abs(deviations[index]))
+        deviation = deviations[cell]
+        if abs(deviation) < DRIFT_LIMIT:
+            return None
+        counts = self.upper_counts if deviation > 0 else self.lower_counts
+        if counts[cell] < DRIFT_SHARE * self.rows:
+            return None
+        return cell
+
+    def to_dict(self) -> dict:
+        return {
+            "cycle": self.cycle,
+            "end": self.end,
+            "rows": self.rows,
+            "spread_mean": self.spread_sum / self.rows if self.rows else None,
+            "spread_max": self.spread_max,
+            "spread_histogram": self.histogram.counts,
+            "deviations": self.deviations,
+            "lower_counts": self.lower_counts,
+            "upper_counts": self.upper_counts,
+            "drifting_cell": self.drifting_cell,
+        }
+
+
+def new_tracker(session: Session, cycle: int) -> BalanceTracker:
+    return BalanceTracker(cycle)
+
+
+def save(session: Session, tracker: BalanceTracker) -> CellBalance:
+    """
+    Ungleichgewicht eines abgeschlossenen Zyklus speichern.
+    """
+    balance = session.merge(CellBalance(**tracker.to_dict()))
+    session.commit()
+    return balance
+
+
+def drift(rows: List[CellBalance]) -> List[Optional[float]]:
+    """
+    Änderung der mittleren Abweichung jeder Zelle in V je 100 Zyklen.
+    """
+    rows = sorted(rows, key=lambda row: row.cycle)
+    cells = max((len(row.deviations or []) for row in rows), default=0)
+    result = []
+    for cell in range(cells):
+        points = [
+            (row.cycle, row.deviations[cell])
+            for row in rows
+            if row.deviations and len(row.deviations) > cell
+        ]
+        change = slope(*zip(*points)) if points else None
+        result.append(None if change is None else change * 100)
+    return result
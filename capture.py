@@ -0,0 +1,96 @@
+"""
+Aufzeichnungen mit hoher Auflösung bei Ereignissen.
+
+Alle Messwerte der letzten Sekunden liegen in einem Ringpuffer.
+Bei einem Auslöser (Fehler oder Grenzwert) wird der Puffer zusammen
+mit den folgenden Messwerten als Aufzeichnung gespeichert.
+"""
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional, Tuple
+
+# (monotone Zeit, Zeitstempel, Kanal, Wert)
+Sample = Tuple[float, datetime, str, float]
+
+
+class CaptureRecorder:
+    """
+    Ringpuffer der Messwerte und laufende Aufzeichnung.
+
+    pre_trigger und post_trigger sind die Sekunden vor und nach
+    dem Auslöser, max_samples begrenzt den Speicherbedarf.
+    """
+
+    def __init__(
+        self,
+        pre_trigger: float = 30,
+        post_trigger: float = 60,
+        max_samples: int = 5000,
+    ):
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.ring: Deque[Sample] = deque(maxlen=max_samples)
+        self.max_samples = max_samples
+        self.samples: List[Sample] = []
+        self.reasons: List[str] = []
+        self.trigger_time: Optional[datetime] = None
+        self.trigger_now = 0.0
+        self.end = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.trigger_time is not None
+
+    def add(self, channel: str, value: float, now: float) -> None:
+        sample = (now, datetime.utcnow(), channel, value)
+        if self.active:
+            if len(self.samples) < self.max_samples:
+                self.samples.append(sample)
+            return
+        self.ring.append(sample)
+        while self.ring and self.ring[0][0] < now - self.pre_trigger:
+            self.ring.popleft()
+
+    def trigger(self, reason: str, now: float) -> float:
+        """
+        Aufzeichnung starten oder eine laufende verlängern.
+
+        Gibt die Sekunden bis zum Ende der Aufzeichnung zurück.
+        """
+        if not self.active:
+            self.trigger_time = datetime.utcnow()
+            self.trigger_now = now
+            self.samples = list(self.ring)
+            self.ring.clear()
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+        self.end = now + self.post_trigger
+        return self.post_trigger
+
+    def poll(self, now: float) -> Optional[dict]:
+        """
+        Abgeschlossene Aufzeichnung zurückgeben, sonst None.
+
+        Die Kanäle werden spaltenweise mit den Sekunden
+        relativ zum Auslöser gespeichert.
+        """
+        if not self.active or now < self.end:
+            return None
+        channels = {}
+        for sample_now, _, channel, value in self.samples:
+            columns = channels.setdefault(channel, {"t": [], "v": []})
+            # monotone Zeit, unabhängig von Sprüngen der Systemzeit
+            columns["t"].append(round(sample_now - self.trigger_now, 3))
+            columns["v"].append(value)
+        capture = {
+            "reason": ", ".join(self.reasons),
+            "trigger_timestamp": self.trigger_time,
+            "start": self.samples[0][1] if self.samples else self.trigger_time,
+            "end": self.samples[-1][1] if self.samples else self.trigger_time,
+            "samples": len(self.samples),
+            "data": channels,
+        }
+        self.samples = []
+        self.reasons = []
+        self.trigger_time = None
+        return capture
@@ -0,0 +1,110 @@
+"""
+Katalog der Zyklen.
+
+Die Zusammenfassung eines Zyklus wird bei jedem Datensatz
+fortgeschrieben, damit keine Abfrage über alle Zeilen nötig ist.
+"""
+from datetime import datetime
+from typing import Optional
+
+from database import CycleSummary, Error, Session
+
+CHANNELS = ("voltage", "current", "charge", "temperature")
+
+
+class CycleCatalogue:
+    """
+    Laufende Zusammenfassung eines Zyklus
+    """
+
+    def __init__(self, cycle: int):
+        self.cycle = cycle
+        self.start: Optional[datetime] = None
+        self.end: Optional[datetime] = None
+        self.rows = 0
+        self.minimum = {}
+        self.maximum = {}
+        self.sums = dict.fromkeys(CHANNELS, 0.0)
+        self.counts = dict.fromkeys(CHANNELS, 0)
+        self.ah_in = 0.0
+        self.ah_out = 0.0
+        self.errors = 0
+
+    def add_row(self, timestamp: datetime, values: dict) -> None:
+        """
+        Datensatz zur Zusammenfassung hinzufügen.
+
+        Die Ladung wird aus dem Strom und der Zeit
+        seit dem letzten Datensatz berechnet.
+        """
+        for channel in CHANNELS:
+            value = values.get(channel)
+            if value is None:
+                continue
+            # Extremwerte des Intervalls, falls vorhanden
+            low = values.get(f"{channel}_min")
+            high = values.get(f"{channel}_max")
+            low = value if low is None else low
+            high = value if high is None else high
+            self.minimum[channel] = min(self.minimum.get(channel, low), low)
+            self.maximum[channel] = max(self.maximum.get(channel, high), high)
+            self.sums[channel] += value
+            self.counts[channel] += 1
+        current = values.get("current")
+        if self.end is not None and current is not None:
+            ah = current * (timestamp - self.end).total_seconds() / 3600
+            if ah > 0:
+                self.ah_in += ah
+            else:
+                self.ah_out -= ah
+        if self.start is None:
+            self.start = timestamp
+        self.end = timestamp
+        self.rows += 1
+
+    def add_stored(self, row) -> None:
+        """
+        Gespeicherte Zeile der Tabelle statistik hinzufügen.
+        """
+        values = {
+            column: getattr(row, column)
+            for channel in CHANNELS
+            for column in (channel, f"{channel}_min", f"{channel}_max")
+        }
+        self.add_row(row.timestamp, values)
+
+    def add_error(self) -> None:
+        self.errors += 1
+
+    def to_dict(self) -> dict:
+        values = {
+            "cycle": self.cycle,
+            "start": self.start,
+            "end": self.end,
+            "rows": self.rows,
+            "ah_in": self.ah_in,
+            "ah_out": self.ah_out,
+            "errors": self.errors,
+        }
+        for channel in CHANNELS:
+            count = self.counts[channel]
+            values[f"{channel}_min"] = self.minimum.get(channel)
+            values[f"{channel}_max"] = self.maximum.get(channel)
+            values[f"{channel}_mean"] = self.sums[channel] / count if count else None
+        return values
+
+
+def new_tracker(session: Session, cycle: int) -> CycleCatalogue:
+    return CycleCatalogue(cycle)
+
+
+def save(session: Session, catalogue: CycleCatalogue) -> CycleSummary:
+    """
+    Zusammenfassung eines abgeschlossenen Zyklus speichern.
+    """
+    catalogue.errors = (
+        session.query(Error).filter(Error.cycle == catalogue.cycle).count()
+    )
+    summary = session.merge(CycleSummary(**catalogue.to_dict()))
+    session.commit()
+    return summary
@@ -0,0 +1,522 @@
+"""
+Komprimierte Speicherung abgeschlossener Zyklen.
+
+Zeitstempel und Zeilennummern werden als Delta-of-Delta,
+die Messwerte als XOR zum vorherigen Wert kodiert (Gorilla).
+Ein Zyklus wird als ein Block in der Tabelle cycle_block gespeichert
+und beim Lesen ohne Umweg über die Festplatte dekodiert.
+"""
+import hashlib
+import multiprocessing
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from logging import getLogger
+from multiprocessing.process import BaseProcess
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy.exc import OperationalError
+
+import balance
+import catalogue
+import health
+import histograms
+from database import (
+    CellBalance,
+    CycleBlock,
+    CycleHealth,
+    CycleHistogram,
+    CycleSummary,
+    Session,
+    Statistik,
+    get_cycle,
+)
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+# NaN mit Payload als Markierung für NULL
+NULL_BITS = 0x7FF8000000000001
+CHANNELS = ("voltage", "current", "charge", "temperature")
+# Kennwerte je Intervall, siehe aggregates.py
+AGGREGATES = tuple(
+    f"{channel}_{name}" for channel in CHANNELS for name in ("min", "max", "samples")
+)
+# Ungleichgewicht der Zellen, siehe balance.py
+BALANCE = ("spread", "lower_cell", "upper_cell")
+# werden als float kodiert und beim Lesen umgewandelt
+INTEGERS = (
+    *(column for column in AGGREGATES if column.endswith("_samples")),
+    "lower_cell",
+    "upper_cell",
+)
+# (Anzahl der führenden Einsen, Bits für den Wert)
+DOD_BUCKETS = ((1, 12), (2, 20), (3, 32), (4, 64))
+
+StatRow = namedtuple(
+    "StatRow",
+    ["row", "timestamp", *CHANNELS, "cell_voltages", *AGGREGATES, *BALANCE],
+    # Blöcke aus der Zeit vor den Kennwerten
+    defaults=[None] * (len(AGGREGATES) + len(BALANCE)),
+)
+
+log = getLogger("Compression")
+
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value: int, bits: int) -> None:
+        self.acc = (self.acc << bits) | (value & ((1 << bits) - 1))
+        self.bits += bits
+        while self.bits >= 8:
+            self.bits -= 8
+            self.buffer.append((self.acc >> self.bits) & 0xFF)
+        self.acc &= (1 << self.bits) - 1
+
+    def getvalue(self) -> bytes:
+        if self.bits:
+            return bytes(self.buffer) + bytes([(self.acc << (8 - self.bits)) & 0xFF])
+        return bytes(self.buffer)
+
+
+class BitReader:
+    def __init__(self, data: bytes):
+        # padding for the window at the end of the data
+        self.data = bytes(data) + bytes(9)
+        self.pos = 0
+
+    def read(self, bits: int) -> int:
+        # 9 bytes hold every read of up to 64 bits at any bit offset
+        start = self.pos >> 3
+        window = int.from_bytes(self.data[start : start + 9], "big")
+        shift = 72 - (self.pos & 7) - bits
+        self.pos += bits
+        return (window >> shift) & ((1 << bits) - 1)
+
+
+def _signed(value: int, bits: int) -> int:
+    if value >= 1 << (bits - 1):
+        return value - (1 << bits)
+    return value
+
+
+class IntEncoder:
+    """
+    Delta-of-Delta Kodierung für Ganzzahlen
+    """
+
+    def __init__(self):
+        self.writer = BitWriter()
+        self.count = 0
+        self.last = 0
+        self.last_delta = 0
+
+    def add(self, value: int) -> None:
+        if self.count == 0:
+            self.writer.write(value, 64)
+        else:
+            delta = value - self.last
+            dod = delta - self.last_delta
+            self.last_delta = delta
+            if dod == 0:
+                self.writer.write(0, 1)
+            else:
+                for ones, bits in DOD_BUCKETS:
+                    if -(1 << (bits - 1)) <= dod < 1 << (bits - 1):
+                        break
+                if ones < 4:
+                    self.writer.write(((1 << ones) - 1) << 1, ones + 1)
+                else:
+                    self.writer.write(0b1111, 4)
+                self.writer.write(dod, bits)
+        self.last = value
+        self.count += 1
+
+    def getvalue(self) -> bytes:
+        return self.writer.getvalue()
+
+
+def decode_ints(data: bytes, count: int) -> Iterator[int]:
+    read = BitReader(data).read
+    bucket_bits = dict(DOD_BUCKETS)
+    last = last_delta = 0
+    for index in range(count):
+        if index == 0:
+            value = _signed(read(64), 64)
+        else:
+            ones = 0
+            while ones < 4 and read(1):
+                ones += 1
+            dod = 0
+            if ones:
+                bits = bucket_bits[ones]
+                dod = _signed(read(bits), bits)
+            last_delta += dod
+            value = last + last_delta
+        last = value
+        yield value
+
+
+def _float_to_bits(value: Optional[float]) -> int:
+    if value is None:
+        return NULL_BITS
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def _bits_to_float(bits: int) -> Optional[float]:
+    if bits == NULL_BITS:
+        return None
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+
+class FloatEncoder:
+    """
+    XOR Kodierung für Fließkommazahlen
+    """
+
+    def __init__(self):
+        self.writer = BitWriter()
+        self.count = 0
+        self.last = 0
+        self.leading = -1
+        self.trailing = 0
+
+    def add(self, value: Optional[float]) -> None:
+        bits = _float_to_bits(value)
+        if self.count == 0:
+            self.writer.write(bits, 64)
+        else:
+            xor = bits ^ self.last
+            if xor == 0:
+                self.writer.write(0, 1)
+            else:
+                leading = 64 - xor.bit_length()
+                trailing = (xor & -xor).bit_length() - 1
+                if (
+                    self.leading >= 0
+                    and leading >= self.leading
+                    and trailing >= self.trailing
+                ):
+                    self.writer.write(0b10, 2)
+                    length = 64 - self.leading - self.trailing
+                    self.writer.write(xor >> self.trailing, length)
+                else:
+                    length = 64 - leading - trailing
+                    self.writer.write(0b11, 2)
+                    self.writer.write(leading, 6)
+                    self.writer.write(length - 1, 6)
+                    self.writer.write(xor >> trailing, length)
+                    self.leading = leading
+                    self.trailing = trailing
+        self.last = bits
+        self.count += 1
+
+    def getvalue(self) -> bytes:
+        return self.writer.getvalue()
+
+
+def decode_floats(data: bytes, count: int) -> Iterator[Optional[float]]:
+    read = BitReader(data).read
+    last = 0
+    leading = trailing = 0
+    value = None
+    for index in range(count):
+        if index == 0:
+            bits = read(64)
+        elif not read(1):
+            # unchanged value, no conversion
+            yield value
+            continue
+        else:
+            if read(1):
+                leading = read(6)
+                length = read(6) + 1
+                trailing = 64 - leading - length
+            bits = last ^ (read(64 - leading - trailing) << trailing)
+        last = bits
+        value = _bits_to_float(bits)
+        yield value
+
+
+def _pack_streams(streams: Sequence[bytes]) -> bytes:
+    return b"".join(struct.pack("<I", len(stream)) + stream for stream in streams)
+
+
+def _unpack_streams(data: bytes) -> List[bytes]:
+    streams = []
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        streams.append(data[offset : offset + length])
+        offset += length
+    return streams
+
+
+def _to_micro(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def encode_rows(rows: Iterable, cells: int = 0) -> Tuple[bytes, str, int]:
+    """
+    Zeilen der Tabelle statistik kodieren.
+
+    Es werden Spalten für mindestens cells Zellen angelegt, hat eine Zeile
+    mehr Zellen, kommen weitere Spalten dazu.
+    Gibt die Daten, die kodierten Spalten und die Anzahl der Zeilen zurück.
+    """
+    timestamps = IntEncoder()
+    row_numbers = IntEncoder()
+    encoders = [FloatEncoder() for _ in (*CHANNELS, *AGGREGATES, *BALANCE)]
+    cell_encoders = [FloatEncoder() for _ in range(cells)]
+    count = 0
+    for row in rows:
+        timestamps.add(_to_micro(row.timestamp))
+        row_numbers.add(row.row)
+        cell_voltages = list(row.cell_voltages or [])
+        while len(cell_encoders) < len(cell_voltages):
+            # the previous rows are missing this cell
+            encoder = FloatEncoder()
+            for _ in range(count):
+                encoder.add(None)
+            cell_encoders.append(encoder)
+        cell_voltages += [None] * (len(cell_encoders) - len(cell_voltages))
+        values = [getattr(row, column) for column in (*CHANNELS, *AGGREGATES, *BALANCE)]
+        values += cell_voltages
+        for encoder, value in zip((*encoders, *cell_encoders), values):
+            encoder.add(value)
+        count += 1
+    columns = [
+        *CHANNELS,
+        *AGGREGATES,
+        *BALANCE,
+        *(f"cell_{cell}" for cell in range(len(cell_encoders))),
+    ]
+    streams = [timestamps.getvalue(), row_numbers.getvalue()]
+    streams += [encoder.getvalue() for encoder in (*encoders, *cell_encoders)]
+    return _pack_streams(streams), ",".join(columns), count
+
+
+def iter_rows(block: CycleBlock) -> Iterator[StatRow]:
+    """
+    Zeilen eines komprimierten Zyklus dekodieren.
+    """
+    count = block.row_count
+    timestamps, row_numbers, *streams = _unpack_streams(block.data)
+    columns = block.columns.split(",")
+    decoders = [decode_floats(stream, count) for stream in streams]
+    for micro, row, values in zip(
+        decode_ints(timestamps, count),
+        decode_ints(row_numbers, count),
+        zip(*decoders),
+    ):
+        channels = dict(zip(columns, values))
+        cell_voltages = [
+            value
+            for column, value in zip(columns, values)
+            if column.startswith("cell_") and value is not None
+        ]
+        for column in INTEGERS:
+            if channels.get(column) is not None:
+                channels[column] = int(channels[column])
+        yield StatRow(
+            row=row,
+            timestamp=EPOCH + micro * MICROSECOND,
+            cell_voltages=cell_voltages,
+            **{
+                column: channels.get(column)
+                for column in (*CHANNELS, *AGGREGATES, *BALANCE)
+            },
+        )
+
+
+def decode_columns(block: CycleBlock, names: Sequence[str]) -> Dict[str, list]:
+    """
+    Nur die genannten Spalten eines komprimierten Zyklus dekodieren.
+
+    Dazu kommen row und timestamp (Mikrosekunden seit 1970),
+    Spalten, die im Block fehlen, sind None.
+    """
+    count = block.row_count
+    timestamps, row_numbers, *streams = _unpack_streams(block.data)
+    streams = dict(zip(block.columns.split(","), streams))
+    columns = {
+        "row": list(decode_ints(row_numbers, count)),
+        "timestamp": list(decode_ints(timestamps, count)),
+    }
+    for name in names:
+        stream = streams.get(name)
+        if stream is None:
+            columns[name] = [None] * count
+        else:
+            columns[name] = list(decode_floats(stream, count))
+    return columns
+
+
+def _canonical(row) -> bytes:
+    """
+    Zeile für den Vergleich vor und nach der Kodierung,
+    alle Zahlen als float wie nach dem Dekodieren.
+    """
+    values = [row.row, _to_micro(row.timestamp)]
+    values += [getattr(row, column) for column in (*CHANNELS, *AGGREGATES, *BALANCE)]
+    values += row.cell_voltages or []
+    return repr([value if value is None else float(value) for value in values]).encode()
+
+
+def compact_cycle(
+    session: Session, cycle: int, trackers: Sequence = ()
+) -> Optional[CycleBlock]:
+    """
+    Zeilen eines abgeschlossenen Zyklus in einen Block komprimieren
+    und aus der Tabelle statistik löschen.
+
+    Die Zeilen werden nur einmal gelesen, jede Zeile wird dabei auch
+    an add_stored der trackers gegeben.
+    """
+    query = (
+        session.query(Statistik)
+        .filter(Statistik.cycle == cycle)
+        .order_by(Statistik.row)
+        .yield_per(1000)
+    )
+    first = last = None
+    original = hashlib.blake2b()
+
+    def read():
+        nonlocal first, last
+        for row in query:
+            for tracker in trackers:
+                tracker.add_stored(row)
+            original.update(_canonical(row))
+            if first is None:
+                first = row
+            last = row
+            yield row
+
+    data, columns, count = encode_rows(read())
+    if first is None:
+        return None
+    block = CycleBlock(
+        cycle=cycle,
+        first_row=first.row,
+        row_count=count,
+        start=first.timestamp,
+        end=last.timestamp,
+        columns=columns,
+        data=data,
+    )
+    # nur löschen, wenn der Block wieder genauso gelesen wird
+    decoded = hashlib.blake2b()
+    for row in iter_rows(block):
+        decoded.update(_canonical(row))
+    if decoded.digest() != original.digest():
+        log.error(f"Zyklus {cycle} kann nicht verlustfrei komprimiert werden")
+        session.expunge_all()
+        return None
+    session.add(block)
+    session.query(Statistik).filter(Statistik.cycle == cycle).delete(
+        synchronize_session=False
+    )
+    session.commit()
+    return block
+
+
+# Tabelle und Modul der Auswertungen abgeschlossener Zyklen,
+# der Katalog zuerst, health verwendet seine Ladung
+ASSESSMENTS = (
+    (CycleSummary, catalogue),
+    (CycleHealth, health),
+    (CellBalance, balance),
+    (CycleHistogram, histograms),
+)
+
+
+def compact_cycles(session: Session, cycles: Iterable[int], pause: float = 0) -> None:
+    """
+    Komprimiert die Zyklen nacheinander mit pause Sekunden dazwischen.
+    """
+    for cycle in cycles:
+        # Zyklen aus der Zeit vor dem Katalog und den Kennwerten
+        # werden im gleichen Durchlauf wie die Komprimierung ausgewertet
+        missing = [
+            (module, module.new_tracker(session, cycle))
+            for model, module in ASSESSMENTS
+            if session.query(model).get(cycle) is None
+        ]
+        try:
+            block = compact_cycle(session, cycle, [tracker for _, tracker in missing])
+            for module, tracker in missing:
+                module.save(session, tracker)
+        except Exception as e:
+            session.rollback()
+            log.error(f"Fehler beim Komprimieren von Zyklus {cycle}: {e!r}")
+        else:
+            if block is not None:
+                log.info(
+                    f"Zyklus {cycle} komprimiert: {block.row_count} Zeilen, "
+                    f"{len(block.data)} Bytes"
+                )
+        time.sleep(pause)
+
+
+def compact_closed_cycles(delay: float = 120, pause: float = 5) -> None:
+    """
+    Komprimiert alle Zyklen vor dem laufenden Zyklus.
+
+    Der laufende Zyklus wird erst nach delay Sekunden bestimmt,
+    wenn server.py ihn angelegt hat.
+    """
+    time.sleep(delay)
+    session = Session()
+    current_cycle = get_cycle(session)
+    cycles = [
+        cycle
+        for (cycle,) in session.query(Statistik.cycle)
+        .filter(Statistik.cycle < current_cycle)
+        .distinct()
+    ]
+    compact_cycles(session, cycles, pause)
+    session.close()
+
+
+def compact_before_seal() -> None:
+    """
+    Komprimiert alle Zyklen der Datenbank vor dem Versiegeln.
+
+    Der Kompaktierer liest nur die aktive Datenbank, Zyklen in einer
+    Partition blieben unkomprimiert. Vor dem Start der Erfassung läuft
+    noch kein Zyklus, alle gespeicherten Zyklen sind abgeschlossen.
+    """
+    session = Session()
+    try:
+        cycles = [cycle for (cycle,) in session.query(Statistik.cycle).distinct()]
+    except OperationalError as e:
+        # Schema einer älteren Version, die Zyklen bleiben unkomprimiert
+        log.error(f"Zyklen vor dem Versiegeln nicht komprimiert: {e!r}")
+        cycles = []
+    compact_cycles(session, cycles)
+    session.close()
+
+
+def start_compactor(delay: float = 120, pause: float = 5) -> BaseProcess:
+    """
+    Komprimiert im Hintergrund alle abgeschlossenen Zyklen.
+
+    Die Kodierung belegt die CPU für Sekunden, sie läuft deshalb in
+    einem eigenen Prozess und nicht neben der Abfrage des BMS.
+    Der Prozess wird mit fork gestartet, spawn und forkserver würden
+    server.py erneut importieren und dabei current_values neu anlegen.
+    fork kopiert nur den aufrufenden Thread, start_compactor muss deshalb
+    vor allen anderen Threads und ohne offene Datenbankverbindung
+    aufgerufen werden.
+    """
+    process = multiprocessing.get_context("fork").Process(
+        target=compact_closed_cycles, args=(delay, pause), daemon=True
+    )
+    process.start()
+    return process
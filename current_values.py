@@ -64,7 +64,7 @@ def _get_values(mmap_reader: MemoryMappedStruct, topics: Tuple[str, ...]):
     except ValueError:
         return {}
     data = dict(zip(topics, values))
-    cell_voltages = values[-4:]
+    cell_voltages = values[-CELLS:]
     data["cell_voltages"] = cell_voltages
     return data
 
@@ -78,7 +78,8 @@ def set_values(values):
 
 
 FILE = "/tmp/current_values.bin"
-STRUCT = struct.Struct("<5i11f")
+CELLS = 4
+STRUCT = struct.Struct(f"<5i15f{CELLS}f")
 TOPICS = (
     "id",
     "row",
@@ -92,6 +93,14 @@ TOPICS = (
     "timestamp",
     "lower_cell_voltage",
     "upper_cell_voltage",
+    "ah_in",
+    "ah_out",
+    "wh_in",
+    "wh_out",
+    "lifetime_ah_in",
+    "lifetime_ah_out",
+    "lifetime_wh_in",
+    "lifetime_wh_out",
 )
 MM_WRITER = MemoryMappedStruct(FILE, STRUCT, writer=True, create=True)
 MM_READER = MemoryMappedStruct(FILE, STRUCT, reader=True)
@@ -0,0 +1,272 @@
+"""
+Schlanker Datenzugriff mit dem Modul sqlite3.
+
+Auf den häufigen Pfaden (Journal schreiben, Statistik exportieren)
+wird das ORM umgangen: vorbereitete Anweisungen, executemany und
+Tupel statt Objekten. Das Schema bleiben die Modelle in database.py.
+
+Mit python3 dal.py werden Durchsatz und Speicherspitze beim Schreiben
+und Lesen im Vergleich zum ORM gemessen. SQLAlchemy wird von server.py
+und api.py für die übrigen Abfragen weiterhin geladen.
+"""
+import json
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
+from datetime import datetime
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence
+
+DB_PATH = Path("/media/data/stats.sqlite")
+# format of SQLAlchemy for DateTime columns on SQLite
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+FETCH_SIZE = 500
+
+StatisticRow = namedtuple(
+    "StatisticRow",
+    "row timestamp voltage current charge temperature cell_voltages",
+)
+
+
+def connect(path: Path = DB_PATH, read_only: bool = False) -> sqlite3.Connection:
+    """
+    Open the database, read_only does not create a missing file.
+    """
+    if read_only:
+        return sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, timeout=30, check_same_thread=False
+        )
+    return sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+
+
+def adapt(value):
+    """
+    Convert a value to the representation of SQLAlchemy.
+    """
+    if isinstance(value, datetime):
+        return value.strftime(DATETIME_FORMAT)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromisoformat(value)
+
+
+@lru_cache(maxsize=64)
+def _insert_statement(table: str, columns: tuple, key: tuple) -> str:
+    statement = (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})"
+    )
+    if key:
+        updates = ", ".join(
+            f"{column} = excluded.{column}" for column in columns if column not in key
+        )
+        action = f"UPDATE SET {updates}" if updates else "NOTHING"
+        statement += f" ON CONFLICT ({', '.join(key)}) DO {action}"
+    return statement
+
+
+def insert_many(
+    connection: sqlite3.Connection,
+    table: str,
+    rows: Sequence[dict],
+    key: Sequence[str] = (),
+) -> int:
+    """
+    Insert the rows with executemany, rows with the same columns share
+    one prepared statement.
+
+    If key is given, an existing row with the same key is updated
+    like Session.merge does. The caller commits.
+    """
+    count = 0
+    for columns, group in groupby(rows, key=tuple):
+        statement = _insert_statement(table, columns, tuple(key))
+        values = [tuple(adapt(row[column]) for column in columns) for row in group]
+        connection.executemany(statement, values)
+        count += len(values)
+    return count
+
+
+def iter_statistik(
+    connection: sqlite3.Connection,
+    cycle: int,
+    since: Optional[datetime] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    until: Optional[datetime] = None,
+) -> Iterator[StatisticRow]:
+    """
+    Rows of the table statistik of a cycle, optional only with a timestamp
+    in (since, until] and with a row number in (since_row, until_row].
+    """
+    statement = (
+        "SELECT row, timestamp, voltage, current, charge, temperature, cell_voltages "
+        "FROM statistik WHERE cycle = ?"
+    )
+    parameters = [cycle]
+    if since is not None:
+        statement += " AND timestamp > ?"
+        parameters.append(adapt(since))
+    if until is not None:
+        statement += " AND timestamp <= ?"
+        parameters.append(adapt(until))
+    if since_row is not None:
+        statement += " AND row > ?"
+        parameters.append(since_row)
+    if until_row is not None:
+        statement += " AND row <= ?"
+        parameters.append(until_row)
+    cursor = connection.execute(statement + " ORDER BY id", parameters)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row, timestamp, *values, cell_voltages in rows:
+            yield StatisticRow(
+                row,
+                parse_datetime(timestamp),
+                *values,
+                json.loads(cell_voltages) if cell_voltages else [],
+            )
+
+
+def read_statistik(
+    path: Path,
+    cycle: int,
+    since: Optional[datetime] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    until: Optional[datetime] = None,
+) -> Iterator[StatisticRow]:
+    """
+    Like iter_statistik, but opens the file read-only and closes it afterwards.
+    """
+    with closing(connect(path, read_only=True)) as connection:
+        yield from iter_statistik(connection, cycle, since, since_row, until_row, until)
+
+
+def table_columns(connection: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+
+
+def read_columns(
+    path: Path,
+    cycle: int,
+    columns: Sequence[str],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> List[tuple]:
+    """
+    Columns of the table statistik of a cycle in one list, optional only
+    with a timestamp in (since, until].
+
+    Columns missing in older partitions are read as NULL.
+    """
+    with closing(connect(path, read_only=True)) as connection:
+        existing = table_columns(connection, "statistik")
+        selected = ", ".join(
+            column if column in existing else "NULL" for column in columns
+        )
+        statement = f"SELECT {selected} FROM statistik WHERE cycle = ?"
+        parameters = [cycle]
+        if since is not None:
+            statement += " AND timestamp > ?"
+            parameters.append(adapt(since))
+        if until is not None:
+            statement += " AND timestamp <= ?"
+            parameters.append(adapt(until))
+        return connection.execute(statement + " ORDER BY id", parameters).fetchall()
+
+
+def last_row(path: Path, cycle: int) -> Optional[int]:
+    """
+    Number of the last stored row of the cycle or None.
+    """
+    if not path.exists():
+        # sealed and not created again yet
+        return None
+    with closing(connect(path, read_only=True)) as connection:
+        # the rows of the running cycle are at the end of the table
+        result = connection.execute(
+            "SELECT row FROM statistik WHERE cycle = ? ORDER BY id DESC LIMIT 1",
+            (cycle,),
+        ).fetchone()
+    return result[0] if result else None
+
+
+def benchmark(rows: int = 20000) -> None:
+    """
+    Compare writing and reading of the table statistik with the ORM.
+    """
+    import tempfile
+    import time
+    import tracemalloc
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from database import Base, Statistik
+
+    values = [
+        {
+            "cycle": 1,
+            "row": row,
+            "timestamp": datetime(2021, 1, 1, row // 3600 % 24, row // 60 % 60),
+            "voltage": 13.2,
+            "current": -1.5,
+            "charge": 80.0,
+            "temperature": 21.0,
+            "cell_voltages": [3.3, 3.3, 3.3, 3.3],
+        }
+        for row in range(rows)
+    ]
+    # each side writes and reads its own cycle
+    dal_values = [{**row, "cycle": 2} for row in values]
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "benchmark.sqlite"
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        connection = connect(path)
+
+        def measure(name, function):
+            tracemalloc.start()
+            start = time.perf_counter()
+            function()
+            duration = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f"{name:24s} {rows / duration:10.0f} Zeilen/s "
+                f"{peak / 1024:8.0f} KiB Spitze"
+            )
+
+        def orm_write():
+            session.bulk_insert_mappings(Statistik, values)
+            session.commit()
+
+        def dal_write():
+            with connection:
+                insert_many(connection, "statistik", dal_values)
+
+        measure("ORM schreiben", orm_write)
+        measure("sqlite3 schreiben", dal_write)
+        measure(
+            "ORM lesen",
+            lambda: session.query(Statistik).filter(Statistik.cycle == 1).all(),
+        )
+        measure("sqlite3 lesen", lambda: sum(1 for _ in iter_statistik(connection, 2)))
+        connection.close()
+        session.close()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,5 +1,9 @@
-from datetime import datetime
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from sqlalchemy import (
     create_engine,
@@ -9,30 +13,59 @@ from sqlalchemy import (
     DateTime,
     Boolean,
     desc,
+    func,
+    Index,
     JSON,
+    LargeBinary,
+    String,
+    or_,
+    text,
 )
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (
     sessionmaker,
     scoped_session,
 )
 
+import dal
+import partitions
 
-DB_PATH = Path("/media/data/stats.sqlite")
+
+DB_PATH = dal.DB_PATH
 DB_BACKUP = Path("/media/data/stats.sqlite.bak")
 DB_ENGINE = f"sqlite:///{DB_PATH}"
+# cycle number of rows, which sum up all cycles
+LIFETIME = 0
 Base = declarative_base()
 
 
-def move_old_database(file_size_limit: int):
+def rotate_database(partition_size_limit: int, data_size_limit: int):
     """
-    Move old database if filesize is bigger than
-    file_size_limit in MiB
+    Seal the database into a partition, if it is bigger than
+    partition_size_limit in MiB or holds data of a previous month.
+
+    All cycles are closed at this time and are compressed before sealing.
+    Afterwards the oldest partitions are deleted, until all
+    data fits into data_size_limit in MiB.
     """
-    file_size_limit *= 1024 ** 2
-    if DB_PATH.exists() and DB_PATH.stat().st_size > file_size_limit:
-        DB_PATH.rename(DB_BACKUP)
-        DB_PATH.touch()
+    if partitions.needs_seal(DB_PATH, partition_size_limit):
+        # the compactor only visits the live database
+        import compression  # imports this module
+
+        compression.compact_before_seal()
+        partitions.seal(DB_PATH)
+        _partition_sessionmaker.cache_clear()
+    reserved = DB_PATH.stat().st_size if DB_PATH.exists() else 0
+    if DB_BACKUP.exists():
+        # backup of the old rotation, which is removed first
+        backup_size = DB_BACKUP.stat().st_size
+        if reserved + backup_size > data_size_limit * 1024 ** 2:
+            DB_BACKUP.unlink()
+        else:
+            reserved += backup_size
+    if partitions.prune(data_size_limit, reserved=reserved):
+        _partition_sessionmaker.cache_clear()
 
 
 class Cycle(Base):
@@ -80,20 +113,277 @@ class Statistik(Base):
     charge = Column(Float)
     cell_voltages = Column(JSON)
     temperature = Column(Float)
+    # voltage, current, charge and temperature are time-weighted means
+    # over the interval since the previous row, see aggregates.py
+    voltage_min = Column(Float)
+    voltage_max = Column(Float)
+    voltage_samples = Column(Integer)
+    current_min = Column(Float)
+    current_max = Column(Float)
+    current_samples = Column(Integer)
+    charge_min = Column(Float)
+    charge_max = Column(Float)
+    charge_samples = Column(Integer)
+    temperature_min = Column(Float)
+    temperature_max = Column(Float)
+    temperature_samples = Column(Integer)
+    # spread of the cell voltages and index of the lowest and highest cell,
+    # see balance.py
+    spread = Column(Float)
+    lower_cell = Column(Integer)
+    upper_cell = Column(Integer)
 
 
-# check if database is bigger as 20 MiB
-# and move it
-# todo: make it dynamic in 4.2
-move_old_database(20)
-engine = create_engine(DB_ENGINE, connect_args={"check_same_thread": False})
-try:
-    Base.metadata.create_all(engine)
-except Exception as e:
-    print(e)
-    DB_PATH.touch()
+class CycleBlock(Base):
+    """
+    Compressed rows of a closed cycle, see compression.py
+    """
+
+    __tablename__ = "cycle_block"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    first_row = Column(Integer, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    start = Column(DateTime)
+    end = Column(DateTime)
+    columns = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
+class CycleSummary(Base):
+    """
+    Catalogue of all cycles, which is updated with every row
+    """
+
+    __tablename__ = "cycle_summary"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    start = Column(DateTime)
+    end = Column(DateTime)
+    rows = Column(Integer, nullable=False, default=0)
+    voltage_min = Column(Float)
+    voltage_max = Column(Float)
+    voltage_mean = Column(Float)
+    current_min = Column(Float)
+    current_max = Column(Float)
+    current_mean = Column(Float)
+    charge_min = Column(Float)
+    charge_max = Column(Float)
+    charge_mean = Column(Float)
+    temperature_min = Column(Float)
+    temperature_max = Column(Float)
+    temperature_mean = Column(Float)
+    ah_in = Column(Float, default=0)
+    ah_out = Column(Float, default=0)
+    errors = Column(Integer, default=0)
+    # index for queries over a time range, see get_cycles_in_range
+    __table_args__ = (Index("ix_cycle_summary_time", "start", "end"),)
+
+
+class ErrorEvent(Base):
+    """
+    Set and clear of a single error bit
+    """
+
+    __tablename__ = "error_event"
+    __table_args__ = (Index("ix_error_event_bit", "bit", "id"),)
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    cycle = Column(Integer, nullable=False)
+    bit = Column(Integer, nullable=False)
+    set_row = Column(Integer, nullable=False)
+    set_timestamp = Column(DateTime)
+    cleared_row = Column(Integer)
+    cleared_timestamp = Column(DateTime)
+
+
+class Energy(Base):
+    """
+    Charge and energy throughput of a cycle or of the LIFETIME
+    """
+
+    __tablename__ = "energy"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    ah_in = Column(Float, nullable=False, default=0)
+    ah_out = Column(Float, nullable=False, default=0)
+    wh_in = Column(Float, nullable=False, default=0)
+    wh_out = Column(Float, nullable=False, default=0)
+
+
+class TimeOffset(Base):
+    """
+    Correction of timestamps after a jump of the system time.
+
+    The delta in seconds is added at read time to all rows
+    of the cycle from row_from up to row_to (excluded).
+    """
+
+    __tablename__ = "time_offset"
+    id = Column(Integer, primary_key=True)
+    cycle = Column(Integer, nullable=False)
+    row_from = Column(Integer, nullable=False)
+    row_to = Column(Integer, nullable=False)
+    delta = Column(Float, nullable=False)
+
+
+class Capture(Base):
+    """
+    Samples at full rate around an error or a crossed limit.
+
+    data holds per channel the seconds relative to trigger_timestamp ("t")
+    and the values ("v").
+    """
+
+    __tablename__ = "capture"
+    id = Column(Integer, primary_key=True)
+    cycle = Column(Integer, nullable=False)
+    row = Column(Integer, nullable=False)
+    reason = Column(String, nullable=False)
+    trigger_timestamp = Column(DateTime, nullable=False)
+    start = Column(DateTime)
+    end = Column(DateTime)
+    samples = Column(Integer, nullable=False, default=0)
+    data = Column(JSON)
+    __table_args__ = (Index("ix_capture_cycle", "cycle"),)
+
+
+class CycleHealth(Base):
+    """
+    State of health of the pack per cycle, see health.py
+    """
+
+    __tablename__ = "cycle_health"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    end = Column(DateTime)
+    capacity = Column(Float)
+    capacity_estimate = Column(Float)
+    resistance = Column(Float)
+    resistance_steps = Column(Integer, nullable=False, default=0)
+    efficiency = Column(Float)
+
+
+class CellBalance(Base):
+    """
+    Imbalance of the cells per cycle, see balance.py
+    """
+
+    __tablename__ = "cell_balance"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    end = Column(DateTime)
+    rows = Column(Integer, nullable=False, default=0)
+    spread_mean = Column(Float)
+    spread_max = Column(Float)
+    spread_histogram = Column(JSON)
+    # mean deviation of each cell from the mean of all cells
+    deviations = Column(JSON)
+    lower_counts = Column(JSON)
+    upper_counts = Column(JSON)
+    drifting_cell = Column(Integer)
+
+
+class CycleHistogram(Base):
+    """
+    Seconds per bin of SoC, temperature and C-rate of a cycle
+    or of the LIFETIME, see histograms.py
+    """
+
+    __tablename__ = "cycle_histogram"
+    cycle = Column(Integer, primary_key=True, autoincrement=False)
+    seconds = Column(Float, nullable=False, default=0)
+    soc = Column(JSON)
+    temperature = Column(JSON)
+    c_rate = Column(JSON)
+
+
+def add_missing_columns(engine) -> None:
+    """
+    Add columns of the models, which are missing in existing tables.
+
+    create_all does not change existing tables.
+    """
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {
+                row[1]
+                for row in connection.execute(text(f"PRAGMA table_info({table.name})"))
+            }
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def add_missing_indexes(engine) -> None:
+    """
+    Create indexes of the models, which are missing in existing tables.
+    """
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def schema_fingerprint() -> int:
+    """
+    Checksum of all tables, columns and indexes of the models.
+
+    It is stored as user_version in the database.
+    """
+    schema = ";".join(
+        f"{table.name}:"
+        + ",".join(f"{column.name} {column.type}" for column in table.columns)
+        + "".join(
+            f"/{index.name}" for index in sorted(table.indexes, key=lambda i: i.name)
+        )
+        for table in sorted(Base.metadata.sorted_tables, key=lambda t: t.name)
+    )
+    return zlib.crc32(schema.encode()) & 0x7FFFFFFF
+
+
+def init_database(partition_size_limit: int = 4, data_size_limit: int = 20) -> bool:
+    """
+    Prepare the database for the acquisition service.
+
+    Only server.py calls this function once at startup. The schema is only
+    changed, if the stored fingerprint differs from the models.
+    Returns True, if the schema was created or updated.
+    """
+    # seal the database into a partition, if it is bigger as 4 MiB
+    # or from a previous month and keep all partitions below 20 MiB
+    # todo: make it dynamic in 4.2
+    rotate_database(partition_size_limit, data_size_limit)
+    fingerprint = schema_fingerprint()
+    with engine.connect() as connection:
+        if connection.execute(text("PRAGMA user_version")).scalar() == fingerprint:
+            return False
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    add_missing_indexes(engine)
+    with engine.begin() as connection:
+        connection.execute(text(f"PRAGMA user_version = {fingerprint}"))
+    # keep the catalogue and error history of the sealed cycles
+    partitions.carry_over(DB_PATH, CycleSummary.__tablename__)
+    partitions.carry_over(DB_PATH, ErrorEvent.__tablename__)
+    partitions.carry_over(DB_PATH, Energy.__tablename__)
+    partitions.carry_over(DB_PATH, Capture.__tablename__)
+    partitions.carry_over(DB_PATH, CycleHealth.__tablename__)
+    partitions.carry_over(DB_PATH, CellBalance.__tablename__)
+    partitions.carry_over(DB_PATH, CycleHistogram.__tablename__)
+    return True
+
+
+# the engines connect on first use
+engine = create_engine(DB_ENGINE, connect_args={"check_same_thread": False})
+read_engine = create_engine(
+    f"sqlite:///file:{DB_PATH}?mode=ro&uri=true",
+    connect_args={"check_same_thread": False},
+)
 Session = scoped_session(sessionmaker(bind=engine))
+# for processes, which only read like api.py
+ReadSession = scoped_session(sessionmaker(bind=read_engine))
 
 
 def to_dict(obj):
@@ -102,11 +392,286 @@ def to_dict(obj):
     return {key: value for key, value in vars(obj).items() if not key.startswith("_")}
 
 
+@lru_cache(maxsize=4)
+def _partition_sessionmaker(path: str, modified: int):
+    # modified is part of the key, a file sealed again
+    # with the same name gets a new engine
+    partition_engine = create_engine(
+        f"sqlite:///file:{path}?mode=ro&uri=true",
+        connect_args={"check_same_thread": False},
+    )
+    return sessionmaker(bind=partition_engine)
+
+
+@contextmanager
+def get_session(session, cycle: int):
+    """
+    Return a session for the sealed partition, which holds the cycle.
+
+    If the cycle is not sealed, the given session is returned.
+    A session of a partition is created for each call and closed afterwards,
+    because sessions must not be shared between threads.
+    """
+    path = partitions.find(cycle) if cycle <= partitions.last_cycle() else None
+    try:
+        modified = path and path.stat().st_mtime_ns
+    except FileNotFoundError:
+        # pruned in the meantime
+        path = None
+    if path is None:
+        yield session
+        return
+    partition_session = _partition_sessionmaker(str(path), modified)()
+    try:
+        yield partition_session
+    finally:
+        partition_session.close()
+
+
+def get_path(cycle: int) -> Path:
+    """
+    Return the file of the database or sealed partition, which holds the cycle.
+    """
+    if cycle <= partitions.last_cycle():
+        path = partitions.find(cycle)
+        if path is not None:
+            return path
+    return DB_PATH
+
+
+def get_time_offsets(session, cycle: int):
+    """
+    Return the time corrections of the cycle as (row_from, row_to, delta)
+    """
+    return (
+        session.query(TimeOffset.row_from, TimeOffset.row_to, TimeOffset.delta)
+        .filter(TimeOffset.cycle == cycle)
+        .all()
+    )
+
+
+def get_cycle_block(session, cycle: int):
+    """
+    Return the compressed block of the cycle or None
+    """
+    try:
+        return session.query(CycleBlock).get(cycle)
+    except OperationalError:
+        # partitions sealed before compression
+        return None
+
+
+def get_cycle_summaries(session, limit: int = 50, before: Optional[int] = None):
+    """
+    Return the catalogue of the newest cycles before the given cycle
+    """
+    query = session.query(CycleSummary)
+    if before is not None:
+        query = query.filter(CycleSummary.cycle < before)
+    return query.order_by(desc(CycleSummary.cycle)).limit(limit).all()
+
+
+def get_time_shifts(session) -> Dict[int, Tuple[float, float]]:
+    """
+    Return per cycle the largest shift of the timestamps by the time
+    corrections into the past and into the future in seconds.
+
+    The corrections of sealed cycles are read from their partitions.
+    """
+    shifts = {}
+
+    def add(source):
+        rows = source.query(TimeOffset.cycle, TimeOffset.delta)
+        for cycle, delta in rows:
+            earlier, later = shifts.get(cycle, (0.0, 0.0))
+            shifts[cycle] = (earlier + min(delta, 0), later + max(delta, 0))
+
+    for entry in partitions.load_index():
+        with get_session(session, entry["first_cycle"]) as partition_session:
+            try:
+                add(partition_session)
+            except OperationalError:
+                # partitions sealed before the time corrections
+                pass
+    add(session)
+    return shifts
+
+
+def get_cycles_in_range(session, start: datetime, end: datetime) -> List[int]:
+    """
+    Return the cycles with rows between start and end, the oldest first.
+
+    The catalogue holds all cycles, also the sealed ones. Its start and end
+    are stored timestamps, they are widened by the time corrections.
+    """
+    shifts = get_time_shifts(session)
+    earliest = min((earlier for earlier, _ in shifts.values()), default=0.0)
+    latest = max((later for _, later in shifts.values()), default=0.0)
+    rows = (
+        session.query(CycleSummary.cycle, CycleSummary.start, CycleSummary.end)
+        .filter(CycleSummary.start <= end - timedelta(seconds=earliest))
+        .filter(
+            or_(
+                CycleSummary.end >= start - timedelta(seconds=latest),
+                CycleSummary.end.is_(None),
+            )
+        )
+        .order_by(CycleSummary.cycle)
+        .all()
+    )
+    cycles = []
+    for cycle, cycle_start, cycle_end in rows:
+        earlier, later = shifts.get(cycle, (0.0, 0.0))
+        if cycle_start + timedelta(seconds=earlier) > end:
+            continue
+        if cycle_end is not None and cycle_end + timedelta(seconds=later) < start:
+            continue
+        cycles.append(cycle)
+    return cycles
+
+
+def get_all_cycles(session) -> List[int]:
+    """
+    Return all cycles with stored rows, the oldest first.
+
+    Cycles from before the catalogue are found in the statistics
+    or the compressed blocks.
+    """
+    cycles = {row[0] for row in session.query(CycleSummary.cycle)}
+    cycles.update(row[0] for row in session.query(CycleBlock.cycle))
+    cycles.update(row[0] for row in session.query(Statistik.cycle).distinct())
+    return sorted(cycles)
+
+
+def get_captures(
+    session,
+    cycle: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: int = 50,
+):
+    """
+    Return the captures without samples, the newest first.
+    """
+    query = session.query(
+        Capture.id,
+        Capture.cycle,
+        Capture.row,
+        Capture.reason,
+        Capture.trigger_timestamp,
+        Capture.start,
+        Capture.end,
+        Capture.samples,
+    )
+    if cycle is not None:
+        query = query.filter(Capture.cycle == cycle)
+    if before is not None:
+        query = query.filter(Capture.id < before)
+    return query.order_by(desc(Capture.id)).limit(limit).all()
+
+
+def get_capture(session, capture_id: int):
+    return session.query(Capture).get(capture_id)
+
+
+def get_error_events(
+    session,
+    bit: Optional[int] = None,
+    cycle: Optional[int] = None,
+    cursor: Optional[int] = None,
+    limit: int = 100,
+):
+    """
+    Return error events, the newest first.
+
+    cursor is the id of the last event of the previous page.
+    """
+    query = session.query(ErrorEvent)
+    if bit is not None:
+        query = query.filter(ErrorEvent.bit == bit)
+    if cycle is not None:
+        query = query.filter(ErrorEvent.cycle == cycle)
+    if cursor is not None:
+        query = query.filter(ErrorEvent.id < cursor)
+    return query.order_by(desc(ErrorEvent.id)).limit(limit).all()
+
+
+def get_last_error_event_id(session) -> int:
+    return session.query(func.max(ErrorEvent.id)).scalar() or 0
+
+
+def get_health(session, limit: int = 100, before: Optional[int] = None):
+    """
+    Return the state of health of the newest cycles before the given cycle
+    """
+    query = session.query(CycleHealth)
+    if before is not None:
+        query = query.filter(CycleHealth.cycle < before)
+    return query.order_by(desc(CycleHealth.cycle)).limit(limit).all()
+
+
+def get_balance(session, limit: int = 100, before: Optional[int] = None):
+    """
+    Return the imbalance of the cells of the newest cycles before the given cycle
+    """
+    query = session.query(CellBalance)
+    if before is not None:
+        query = query.filter(CellBalance.cycle < before)
+    return query.order_by(desc(CellBalance.cycle)).limit(limit).all()
+
+
+def get_initial_capacity(session) -> Optional[float]:
+    """
+    Return the capacity of the oldest cycle with a known capacity or None
+    """
+    row = (
+        session.query(CycleHealth.capacity)
+        .filter(CycleHealth.capacity.isnot(None))
+        .order_by(CycleHealth.cycle)
+        .first()
+    )
+    return row[0] if row else None
+
+
+def get_capacity(session, cycle: int) -> Optional[float]:
+    """
+    Return the last capacity reported by the BMS up to the cycle or None
+    """
+    row = (
+        session.query(Configuration.capacity)
+        .filter(Configuration.cycle <= cycle, Configuration.capacity.isnot(None))
+        .order_by(desc(Configuration.cycle), desc(Configuration.id))
+        .first()
+    )
+    return row[0] if row else None
+
+
+def get_histogram(session, cycle: int):
+    """
+    Return the histograms of the cycle or the LIFETIME or None
+    """
+    return session.query(CycleHistogram).get(cycle)
+
+
+def get_histograms(session, cycles: List[int]):
+    """
+    Return the histograms of the cycles
+    """
+    return session.query(CycleHistogram).filter(CycleHistogram.cycle.in_(cycles)).all()
+
+
+def get_energy(session, cycle: int):
+    """
+    Return the throughput of the cycle or None
+    """
+    return session.query(Energy).get(cycle)
+
+
 def get_cycle(session):
     cycle = session.query(Cycle.cycle).order_by(desc("id")).first()
     if cycle:
         return cycle[0]
-    return 0
+    # the database has been sealed, continue with the last cycle
+    return partitions.last_cycle()
 
 
 def set_cycle(session):
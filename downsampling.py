@@ -0,0 +1,58 @@
+"""
+Reduktion von Zeitreihen für Diagramme.
+
+Largest-Triangle-Three-Buckets (LTTB) wählt je Bucket den Punkt,
+der mit dem zuletzt gewählten Punkt und dem Mittelwert des nächsten
+Buckets das größte Dreieck bildet. Spitzen bleiben dadurch erhalten.
+"""
+from typing import Sequence
+
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indizes der gewählten Punkte, höchstens points.
+
+    Der erste und der letzte Punkt werden immer gewählt.
+    Fehlende Werte (NaN) werden nie bevorzugt.
+    """
+    count = len(x)
+    if points >= count or points < 3:
+        return np.arange(count)
+    # Grenzen der Buckets ohne den ersten und letzten Punkt
+    edges = (np.arange(points - 1) * (count - 2) / (points - 2)).astype(np.int64) + 1
+    edges[-1] = count - 1
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    last = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else count
+        next_y = y[end:next_end]
+        if np.isnan(next_y).all():
+            average_y = y[last]
+        else:
+            average_y = np.nanmean(next_y)
+        average_x = x[end:next_end].mean()
+        area = np.abs(
+            (x[last] - average_x) * (y[start:end] - y[last])
+            - (x[last] - x[start:end]) * (average_y - y[last])
+        )
+        last = start + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        selected[bucket + 1] = last
+    return selected
+
+
+def select(x: np.ndarray, channels: Sequence[np.ndarray], points: int) -> np.ndarray:
+    """
+    Indizes für mehrere Kanäle mit gemeinsamer Zeitachse.
+
+    Jeder Kanal wird für sich reduziert, zurückgegeben wird die
+    sortierte Vereinigung, also höchstens points je Kanal.
+    """
+    indices = [lttb(x, y, points) for y in channels]
+    if not indices:
+        return np.arange(len(x))
+    return np.unique(np.concatenate(indices))
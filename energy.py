@@ -0,0 +1,118 @@
+"""
+Zähler für Ladung und Energie.
+
+Strom und Leistung werden bei jedem Messwert des Stroms
+mit der Trapezregel integriert, getrennt nach Laden und Entladen.
+"""
+from typing import Optional, Tuple
+
+
+class Throughput:
+    """
+    Geladene und entladene Ah und Wh
+    """
+
+    def __init__(
+        self,
+        ah_in: float = 0.0,
+        ah_out: float = 0.0,
+        wh_in: float = 0.0,
+        wh_out: float = 0.0,
+    ):
+        self.ah_in = ah_in
+        self.ah_out = ah_out
+        self.wh_in = wh_in
+        self.wh_out = wh_out
+
+    @classmethod
+    def from_row(cls, row) -> "Throughput":
+        if row is None:
+            return cls()
+        return cls(row.ah_in, row.ah_out, row.wh_in, row.wh_out)
+
+    def add(self, ah: Tuple[float, float], wh: Tuple[float, float]) -> None:
+        self.ah_in += ah[0]
+        self.ah_out += ah[1]
+        self.wh_in += wh[0]
+        self.wh_out += wh[1]
+
+    def to_dict(self) -> dict:
+        return {
+            "ah_in": self.ah_in,
+            "ah_out": self.ah_out,
+            "wh_in": self.wh_in,
+            "wh_out": self.wh_out,
+        }
+
+
+def trapezoid(y0: float, y1: float, seconds: float) -> Tuple[float, float]:
+    """
+    Fläche zwischen zwei Messwerten in Stunden,
+    aufgeteilt in positiven und negativen Anteil.
+
+    Bei einem Vorzeichenwechsel wird am Nulldurchgang geteilt.
+    """
+    hours = seconds / 3600
+    if y0 >= 0 and y1 >= 0:
+        return (y0 + y1) / 2 * hours, 0.0
+    if y0 <= 0 and y1 <= 0:
+        return 0.0, -(y0 + y1) / 2 * hours
+    fraction = y0 / (y0 - y1)
+    first = y0 / 2 * fraction * hours
+    second = y1 / 2 * (1 - fraction) * hours
+    if first > 0:
+        return first, -second
+    return second, -first
+
+
+class EnergyCounter:
+    """
+    Integriert Strom und Leistung für den Zyklus und die Lebensdauer.
+
+    Lücken größer als max_gap Sekunden werden nicht integriert.
+    """
+
+    def __init__(self, lifetime: Optional[Throughput] = None, max_gap: float = 300):
+        self.cycle = Throughput()
+        self.lifetime = lifetime or Throughput()
+        self.max_gap = max_gap
+        self.last: Optional[Tuple[float, float, float]] = None
+
+    def update(self, current: float, voltage: float, now: float) -> None:
+        """
+        Neuen Messwert des Stroms integrieren.
+
+        now ist die Zeit in Sekunden einer monotonen Uhr.
+        """
+        power = current * voltage
+        if self.last is not None:
+            last_now, last_current, last_power = self.last
+            seconds = now - last_now
+            if 0 < seconds <= self.max_gap:
+                ah = trapezoid(last_current, current, seconds)
+                wh = trapezoid(last_power, power, seconds)
+                self.cycle.add(ah, wh)
+                self.lifetime.add(ah, wh)
+        self.last = (now, current, power)
+
+
+def kpis(throughput: Throughput, capacity: Optional[float]) -> dict:
+    """
+    Kennzahlen aus den Zählern: äquivalente Vollzyklen
+    und Wirkungsgrad von Ladung und Energie.
+    """
+    full_cycles = None
+    if capacity:
+        full_cycles = throughput.ah_out / capacity
+    charge_efficiency = None
+    if throughput.ah_in:
+        charge_efficiency = throughput.ah_out / throughput.ah_in
+    energy_efficiency = None
+    if throughput.wh_in:
+        energy_efficiency = throughput.wh_out / throughput.wh_in
+    return {
+        **throughput.to_dict(),
+        "equivalent_full_cycles": full_cycles,
+        "charge_efficiency": charge_efficiency,
+        "energy_efficiency": energy_efficiency,
+    }
@@ -0,0 +1,143 @@
+"""
+Zwischenspeicher für Exporte abgeschlossener Zyklen.
+
+Ein abgeschlossener Zyklus ändert sich nicht mehr. Jeder Export wird
+deshalb nur einmal erzeugt, mit gzip komprimiert und im Verzeichnis
+CACHE_PATH abgelegt. Der Dateiname enthält die Prüfsumme des Inhalts,
+die als starkes ETag dient. Übersteigen alle Dateien zusammen das
+Budget, werden die am längsten nicht gelesenen gelöscht.
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, Iterator, Optional, Union
+
+import writes
+
+CACHE_PATH = Path("/media/data/export-cache")
+SIZE_LIMIT = 20 * 1024 ** 2
+COMPRESS_LEVEL = 6
+CHUNK_SIZE = 64 * 1024
+SUFFIX = ".gz"
+
+Entry = namedtuple("Entry", "path etag size")
+
+
+def cache_key(*parts) -> str:
+    """
+    Schlüssel aus den Parametern des Exports, geeignet als Dateiname.
+    """
+    return "-".join(str(part).replace("/", "_") for part in parts)
+
+
+class ExportCache:
+    """
+    Komprimierte Exporte mit LRU-Verdrängung nach Größe.
+
+    Die Reihenfolge der Zugriffe wird nur im Speicher geführt,
+    damit ein Treffer nicht auf die SD-Karte schreibt. Nach einem
+    Neustart gilt die Reihenfolge der Änderungszeiten.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, size_limit: int = SIZE_LIMIT):
+        self.path = path
+        self.size_limit = size_limit
+        self.entries: "OrderedDict[str, Entry]" = OrderedDict()
+        self.lock = Lock()
+        self.loaded = False
+
+    def _load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path.exists():
+            return
+        for file in self.path.glob(".*.tmp"):
+            # abgebrochene Exporte
+            file.unlink()
+        files = sorted(self.path.glob(f"*{SUFFIX}"), key=lambda f: f.stat().st_mtime)
+        for file in files:
+            key, _, etag = file.name[: -len(SUFFIX)].rpartition(".")
+            self.entries[key] = Entry(file, etag, file.stat().st_size)
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def get(self, key: str) -> Optional[Entry]:
+        """
+        Eintrag zum Schlüssel oder None.
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not entry.path.exists():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, chunks: Iterable[Union[str, bytes]]) -> Entry:
+        """
+        Export komprimiert speichern.
+
+        Die Datei wird erst nach dem vollständigen Schreiben unter
+        ihrem Namen sichtbar.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha1()
+        fd, name = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.path)
+        temp = Path(name)
+        try:
+            with open(fd, "wb") as raw, gzip.GzipFile(
+                fileobj=raw, mode="wb", compresslevel=COMPRESS_LEVEL, mtime=0
+            ) as file:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    file.write(chunk)
+            etag = digest.hexdigest()
+            path = self.path / f"{key}.{etag}{SUFFIX}"
+            os.replace(temp, path)
+        except BaseException:
+            if temp.exists():
+                temp.unlink()
+            raise
+        entry = Entry(path, etag, path.stat().st_size)
+        writes.account(writes.CACHE, entry.size)
+        with self.lock:
+            self._load()
+            old = self.entries.pop(key, None)
+            if old is not None and old.path != path and old.path.exists():
+                old.path.unlink()
+            self.entries[key] = entry
+            self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        # der neueste Eintrag bleibt, auch wenn er allein zu groß ist
+        total = self.size
+        while total > self.size_limit and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            total -= entry.size
+            if entry.path.exists():
+                entry.path.unlink()
+
+
+def iter_decompressed(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Inhalt für Clients ohne gzip in Blöcken lesen.
+    """
+    with gzip.open(path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,215 @@
+"""
+Zustand (State of Health) des Akkus je Zyklus.
+
+Die Kennwerte werden wie der Katalog bei jedem Datensatz fortgeschrieben
+und sind beim Ende des Zyklus fertig, ohne alle Zeilen erneut zu lesen:
+
+- Innenwiderstand aus der Spannungsänderung bei Stromsprüngen zwischen
+  zwei Datensätzen (Ausgleichsgerade durch den Ursprung über alle Sprünge)
+- Kapazität aus der gezählten Ladung im Verhältnis zur Änderung der vom
+  BMS gemeldeten Ladung (Regression über den Zyklus)
+- Coulomb-Wirkungsgrad aus geladenen und entladenen Ah, korrigiert um
+  die Änderung der gespeicherten Ladung
+
+Da die Datensätze Mittelwerte über ihr Intervall sind, gilt der lineare
+Zusammenhang U = U0 + R * I (I > 0 beim Laden) auch für die Mittelwerte.
+"""
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from database import CycleHealth, CycleSummary, Session, get_capacity
+
+# Mindestsprung des Stroms in A für eine Messung des Widerstands
+MIN_STEP = 2.0
+# längster Abstand zweier Datensätze in Sekunden für einen Sprung
+MAX_STEP_SECONDS = 600.0
+# kleinste Änderung der Ladung als Anteil der Kapazität für die Schätzung
+MIN_SWING = 0.2
+# kleinste geladene Ah als Anteil der Kapazität für den Wirkungsgrad
+MIN_THROUGHPUT = 0.1
+# kleinste Anzahl geschätzter Kapazitäten für die Entwicklung
+MIN_ESTIMATES = 3
+
+
+class HealthTracker:
+    """
+    Laufende Kennwerte des Zustands eines Zyklus
+    """
+
+    def __init__(self, cycle: int, capacity: Optional[float] = None):
+        self.cycle = cycle
+        self.capacity = capacity
+        self.end: Optional[datetime] = None
+        self.last: Optional[tuple] = None
+        # Summen für den Widerstand
+        self.steps = 0
+        self.dv_di = 0.0
+        self.di_di = 0.0
+        # Summen für die Regression der gezählten über die gemeldete Ladung
+        self.net_ah = 0.0
+        self.samples = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+        self.first_charge: Optional[float] = None
+        self.last_charge: Optional[float] = None
+        self.min_charge: Optional[float] = None
+        self.max_charge: Optional[float] = None
+        self.ah_in = 0.0
+        self.ah_out = 0.0
+
+    def add_row(self, timestamp: datetime, values: dict) -> None:
+        """
+        Datensatz zu den Kennwerten hinzufügen.
+
+        Die Ladung wird wie im Katalog aus dem Strom und der Zeit
+        seit dem letzten Datensatz berechnet.
+        """
+        voltage = values.get("voltage")
+        current = values.get("current")
+        charge = values.get("charge")
+        if self.last is not None and current is not None:
+            last_timestamp, last_voltage, last_current = self.last
+            seconds = (timestamp - last_timestamp).total_seconds()
+            if 0 < seconds <= MAX_STEP_SECONDS and last_current is not None:
+                ah = (last_current + current) / 2 * seconds / 3600
+                self.net_ah += ah
+                if ah > 0:
+                    self.ah_in += ah
+                else:
+                    self.ah_out -= ah
+                di = current - last_current
+                if abs(di) >= MIN_STEP and None not in (voltage, last_voltage):
+                    self.steps += 1
+                    self.dv_di += (voltage - last_voltage) * di
+                    self.di_di += di * di
+        if charge is not None:
+            if self.first_charge is None:
+                self.first_charge = self.min_charge = self.max_charge = charge
+            self.last_charge = charge
+            self.min_charge = min(self.min_charge, charge)
+            self.max_charge = max(self.max_charge, charge)
+            self.samples += 1
+            self.sum_x += charge
+            self.sum_y += self.net_ah
+            self.sum_xx += charge * charge
+            self.sum_xy += charge * self.net_ah
+        self.last = (timestamp, voltage, current)
+        self.end = timestamp
+
+    def add_stored(self, row) -> None:
+        """
+        Gespeicherte Zeile der Tabelle statistik hinzufügen.
+        """
+        values = {
+            "voltage": row.voltage,
+            "current": row.current,
+            "charge": row.charge,
+        }
+        self.add_row(row.timestamp, values)
+
+    @property
+    def resistance(self) -> Optional[float]:
+        if not self.steps:
+            return None
+        return self.dv_di / self.di_di
+
+    @property
+    def capacity_estimate(self) -> Optional[float]:
+        if not self.capacity or self.first_charge is None:
+            return None
+        if self.max_charge - self.min_charge < MIN_SWING * self.capacity:
+            return None
+        variance = self.samples * self.sum_xx - self.sum_x * self.sum_x
+        if variance <= 0:
+            return None
+        slope = (self.samples * self.sum_xy - self.sum_x * self.sum_y) / variance
+        # gezählte Ah je gemeldeter Ah
+        return self.capacity * slope
+
+    @property
+    def efficiency(self) -> Optional[float]:
+        if self.first_charge is None or not self.ah_in:
+            return None
+        if self.capacity and self.ah_in < MIN_THROUGHPUT * self.capacity:
+            return None
+        stored = self.last_charge - self.first_charge
+        estimate = self.capacity_estimate
+        if estimate:
+            # die gemeldete Ladung in gezählte Ah umrechnen
+            stored *= estimate / self.capacity
+        return (self.ah_out + stored) / self.ah_in
+
+    def to_dict(self) -> dict:
+        return {
+            "cycle": self.cycle,
+            "end": self.end,
+            "capacity": self.capacity,
+            "capacity_estimate": self.capacity_estimate,
+            "resistance": self.resistance,
+            "resistance_steps": self.steps,
+            "efficiency": self.efficiency,
+        }
+
+
+def new_tracker(session: Session, cycle: int) -> HealthTracker:
+    return HealthTracker(cycle, get_capacity(session, cycle))
+
+
+def save(session: Session, tracker: HealthTracker) -> CycleHealth:
+    """
+    Kennwerte eines abgeschlossenen Zyklus speichern.
+    """
+    summary = session.query(CycleSummary).get(tracker.cycle)
+    if summary is not None and summary.ah_in:
+        # genauer als die Berechnung aus den gespeicherten Zeilen
+        tracker.ah_in = summary.ah_in
+        tracker.ah_out = summary.ah_out
+    health = session.merge(CycleHealth(**tracker.to_dict()))
+    session.commit()
+    return health
+
+
+def slope(xs: Sequence[float], ys: Sequence[float]) -> Optional[float]:
+    """
+    Steigung der Ausgleichsgeraden oder None bei weniger als zwei Punkten.
+    """
+    count = len(xs)
+    if count < 2:
+        return None
+    mean_x = sum(xs) / count
+    mean_y = sum(ys) / count
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+def trend(rows: List[CycleHealth], initial: Optional[float] = None) -> dict:
+    """
+    Entwicklung über die Zyklen: Änderung der Kapazität und des
+    Widerstands je 100 Zyklen und der Zustand als Anteil der Kapazität
+    initial, ohne initial der ersten geschätzten Kapazität in rows.
+
+    Für die Kapazität zählen nur die Schätzungen, nicht die vom BMS
+    gemeldete Nennkapazität. Mit weniger als MIN_ESTIMATES Schätzungen
+    sind Änderung und Zustand None.
+    """
+    rows = sorted(rows, key=lambda row: row.cycle)
+    capacities = [
+        (row.cycle, row.capacity_estimate) for row in rows if row.capacity_estimate
+    ]
+    resistances = [
+        (row.cycle, row.resistance) for row in rows if row.resistance is not None
+    ]
+    capacity_slope = state_of_health = None
+    if len(capacities) >= MIN_ESTIMATES:
+        capacity_slope = slope(*zip(*capacities))
+        state_of_health = capacities[-1][1] / (initial or capacities[0][1])
+    resistance_slope = slope(*zip(*resistances)) if resistances else None
+    return {
+        "capacity_per_100_cycles": capacity_slope and capacity_slope * 100,
+        "resistance_per_100_cycles": resistance_slope and resistance_slope * 100,
+        "state_of_health": state_of_health,
+    }
@@ -0,0 +1,179 @@
+"""
+Histogramme der Messwerte mit festen Klassen.
+
+Je Zyklus und für die Lebensdauer wird gezählt, wie viele Sekunden der
+Akku in jeder Klasse von Ladezustand, Temperatur und C-Rate verbracht hat.
+Die Histogramme werden bei jedem Datensatz fortgeschrieben. Mehrere
+Zyklen werden durch Addition der Klassen zusammengefasst, der Aufwand
+hängt nur von der Anzahl der Klassen ab und nicht von den Zeilen.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from database import CycleHistogram, Session, get_capacity
+
+# Kanal: (untere Grenze, Breite der Klassen, Anzahl der Klassen)
+# Werte außerhalb zählen zur ersten bzw. letzten Klasse.
+CHANNELS = {
+    "soc": (0.0, 5.0, 20),
+    "temperature": (-20.0, 5.0, 14),
+    "c_rate": (-1.0, 0.1, 20),
+}
+# längster Abstand zweier Datensätze in Sekunden, der gezählt wird
+MAX_GAP = 600.0
+
+
+class Histogram:
+    """
+    Summen je Klasse mit fester Breite
+    """
+
+    def __init__(
+        self, low: float, width: float, bins: int, counts: Optional[List] = None
+    ):
+        self.low = low
+        self.width = width
+        self.bins = bins
+        self.counts = list(counts) if counts and len(counts) == bins else [0] * bins
+
+    def add(self, value: float, weight: float = 1) -> None:
+        index = int((value - self.low) // self.width)
+        self.counts[min(max(index, 0), self.bins - 1)] += weight
+
+    def merge(self, counts: Sequence) -> None:
+        """
+        Summen eines Histogramms mit gleichen Klassen addieren.
+        """
+        for index, count in enumerate(counts[: self.bins]):
+            self.counts[index] += count
+
+    @property
+    def edges(self) -> List[float]:
+        return [
+            round(self.low + index * self.width, 6) for index in range(self.bins + 1)
+        ]
+
+
+def empty() -> Dict[str, Histogram]:
+    return {channel: Histogram(*bins) for channel, bins in CHANNELS.items()}
+
+
+def channel_values(values: dict, capacity: Optional[float]) -> Dict[str, float]:
+    """
+    Werte eines Datensatzes für die Kanäle der Histogramme.
+    """
+    result = {}
+    charge = values.get("charge")
+    current = values.get("current")
+    if capacity and charge is not None:
+        result["soc"] = charge / capacity * 100
+    if values.get("temperature") is not None:
+        result["temperature"] = values["temperature"]
+    if capacity and current is not None:
+        result["c_rate"] = current / capacity
+    return result
+
+
+class HistogramTracker:
+    """
+    Histogramme eines Zyklus und der Lebensdauer.
+
+    Ein Datensatz zählt mit der Zeit seit dem vorherigen Datensatz,
+    seine Werte sind die Mittelwerte dieses Intervalls.
+    """
+
+    def __init__(
+        self,
+        cycle: int,
+        lifetime: Optional[CycleHistogram] = None,
+        capacity: Optional[float] = None,
+    ):
+        self.cycle = cycle
+        self.capacity = capacity
+        self.histograms = empty()
+        self.seconds = 0.0
+        self.lifetime = empty()
+        self.lifetime_seconds = 0.0
+        if lifetime is not None:
+            self.lifetime_seconds = lifetime.seconds or 0.0
+            for channel, histogram in self.lifetime.items():
+                histogram.merge(getattr(lifetime, channel) or [])
+        self.last: Optional[datetime] = None
+
+    def add_row(self, timestamp: datetime, values: dict) -> None:
+        last, self.last = self.last, timestamp
+        if last is None:
+            return
+        seconds = (timestamp - last).total_seconds()
+        if not 0 < seconds <= MAX_GAP:
+            return
+        self.seconds += seconds
+        self.lifetime_seconds += seconds
+        for channel, value in channel_values(values, self.capacity).items():
+            self.histograms[channel].add(value, seconds)
+            self.lifetime[channel].add(value, seconds)
+
+    def add_stored(self, row) -> None:
+        """
+        Gespeicherte Zeile der Tabelle statistik hinzufügen.
+        """
+        values = {
+            "charge": row.charge,
+            "current": row.current,
+            "temperature": row.temperature,
+        }
+        self.add_row(row.timestamp, values)
+
+    def to_dict(self) -> dict:
+        return to_row(self.cycle, self.seconds, self.histograms)
+
+    def lifetime_to_dict(self, cycle: int) -> dict:
+        return to_row(cycle, self.lifetime_seconds, self.lifetime)
+
+
+def to_row(cycle: int, seconds: float, histograms: Dict[str, Histogram]) -> dict:
+    return {
+        "cycle": cycle,
+        "seconds": seconds,
+        **{channel: histogram.counts for channel, histogram in histograms.items()},
+    }
+
+
+def new_tracker(session: Session, cycle: int) -> HistogramTracker:
+    return HistogramTracker(cycle, capacity=get_capacity(session, cycle))
+
+
+def save(session: Session, tracker: HistogramTracker) -> CycleHistogram:
+    """
+    Histogramme eines abgeschlossenen Zyklus speichern.
+
+    Die Lebensdauer wird nicht geändert, sie zählt nur die erfassten Zyklen.
+    """
+    histogram = session.merge(CycleHistogram(**tracker.to_dict()))
+    session.commit()
+    return histogram
+
+
+def merge(rows: Iterable[CycleHistogram]) -> dict:
+    """
+    Histogramme mehrerer Zyklen addieren.
+
+    Je Kanal werden die Grenzen der Klassen und die Sekunden je Klasse
+    zurückgegeben.
+    """
+    histograms = empty()
+    seconds = 0.0
+    count = 0
+    for row in rows:
+        seconds += row.seconds or 0.0
+        count += 1
+        for channel, histogram in histograms.items():
+            histogram.merge(getattr(row, channel) or [])
+    return {
+        "cycles": count,
+        "seconds": seconds,
+        "channels": {
+            channel: {"edges": histogram.edges, "seconds": histogram.counts}
+            for channel, histogram in histograms.items()
+        },
+    }
@@ -0,0 +1,245 @@
+"""
+Schreibpuffer im RAM für die Datenbank.
+
+Alle Datensätze werden zuerst an ein Journal im tmpfs angehängt
+und in großen Blöcken mit executemany in die Datenbank
+auf der SD-Karte geschrieben.
+Nach einem Neustart des Dienstes werden nicht geschriebene
+Einträge aus dem Journal wiederhergestellt.
+"""
+import json
+import time
+from contextlib import closing
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Type
+
+from sqlalchemy import DateTime
+
+import dal
+import writes
+from database import Base
+
+# /tmp liegt bei Raspberry Pi OS auf der SD-Karte, /dev/shm ist ein tmpfs
+JOURNAL_FILE = Path("/dev/shm/journal.jsonl")
+FLUSH_FILE = Path("/dev/shm/journal.flush.jsonl")
+# wird nach jedem Schreiben berührt, andere Prozesse erkennen daran neue Daten
+FLUSHED_FILE = Path("/dev/shm/journal.flushed")
+# Sekunden bis zum Schreiben, Leser sehen Daten höchstens so alt.
+# Über dem Schreibbudget wird das Intervall gestreckt.
+FLUSH_INTERVAL = 30
+
+log = getLogger("Journal")
+
+
+def last_flush(flushed_file: Path = FLUSHED_FILE) -> int:
+    """
+    Zeitpunkt des letzten Schreibens in die Datenbank in ns, 0 ohne.
+    """
+    try:
+        return flushed_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _models() -> Dict[str, Type[Base]]:
+    return {
+        mapper.class_.__tablename__: mapper.class_ for mapper in Base.registry.mappers
+    }
+
+
+def _datetime_columns(model: Type[Base]) -> List[str]:
+    return [
+        column.key
+        for column in model.__table__.columns
+        if isinstance(column.type, DateTime)
+    ]
+
+
+class Journal:
+    """
+    Journal für Datensätze, die verzögert gespeichert werden.
+
+    flush_interval ist die Zeit in Sekunden, nach der das Journal
+    spätestens in die Datenbank geschrieben wird.
+    write_budget sind die Bytes pro Tag, bei Überschreitung
+    wird flush_interval gestreckt.
+    """
+
+    def __init__(
+        self,
+        journal_file: Path = JOURNAL_FILE,
+        flush_file: Path = FLUSH_FILE,
+        flush_interval: float = FLUSH_INTERVAL,
+        write_budget: Optional[float] = None,
+        flushed_file: Path = FLUSHED_FILE,
+    ):
+        self.journal_file = journal_file
+        self.flush_file = flush_file
+        self.flushed_file = flushed_file
+        self.flush_interval = flush_interval
+        self.write_budget = write_budget
+        self.models = _models()
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.flush_event = Event()
+        self.recover()
+        self.fd = self.journal_file.open("a")
+
+    def _append(self, entry: dict) -> None:
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.fd.write(line + "\n")
+            self.fd.flush()
+
+    def add(self, model: Type[Base], **values) -> None:
+        """
+        Datensatz an das Journal anhängen.
+
+        Fehlende Zeitstempel werden jetzt gesetzt und nicht erst
+        beim Schreiben in die Datenbank.
+        """
+        for key in _datetime_columns(model):
+            if values.get(key) is None:
+                values[key] = datetime.utcnow()
+        self._append({"table": model.__tablename__, "values": values})
+
+    def merge(self, model: Type[Base], **values) -> None:
+        """
+        Datensatz anhängen, der einen vorhandenen Datensatz
+        mit gleichem Primärschlüssel ersetzt.
+        """
+        self._append({"table": model.__tablename__, "values": values, "merge": True})
+
+    def _rotate(self) -> None:
+        with self.lock:
+            self.fd.close()
+            if self.journal_file.exists():
+                self.journal_file.replace(self.flush_file)
+            self.fd = self.journal_file.open("a")
+
+    def _read(self, file: Path) -> List[dict]:
+        entries = []
+        with file.open() as fd:
+            for line in fd:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last line could be incomplete after a crash
+                    log.warning(f"Fehlerhafter Eintrag im Journal: {line!r}")
+        return entries
+
+    def _primary_key(self, table: str) -> List[str]:
+        return [column.name for column in self.models[table].__table__.primary_key]
+
+    def _collect(self, entries: List[dict]) -> tuple:
+        """
+        Einträge nach Tabellen ordnen.
+
+        Neue Datensätze werden je Tabelle gesammelt, damit sie in einem
+        executemany geschrieben werden. Von mehreren Ersetzungen mit
+        gleichem Primärschlüssel bleibt nur eine, in der alle Werte
+        nacheinander aktualisiert sind.
+        """
+        inserts: Dict[str, List[dict]] = {}
+        merges: Dict[str, Dict[tuple, dict]] = {}
+        for number, entry in enumerate(entries):
+            table = entry["table"]
+            values = entry["values"]
+            if not entry.get("merge"):
+                inserts.setdefault(table, []).append(values)
+                continue
+            key = tuple(values.get(column) for column in self._primary_key(table))
+            if None in key:
+                # without the key every entry is a new row
+                key = (None, number)
+            merges.setdefault(table, {}).setdefault(key, {}).update(values)
+        return inserts, merges
+
+    def _convert(self, table: str, rows: List[dict]) -> List[dict]:
+        dt_columns = _datetime_columns(self.models[table])
+        for row in rows:
+            for column in dt_columns:
+                if isinstance(row.get(column), str):
+                    row[column] = datetime.fromisoformat(row[column])
+        return rows
+
+    def _write(self, file: Path) -> int:
+        entries = self._read(file)
+        inserts, merges = self._collect(entries)
+        io_before = writes.io_written()
+        size_before = dal.DB_PATH.stat().st_size if dal.DB_PATH.exists() else 0
+        with closing(dal.connect()) as connection:
+            # one transaction for the whole journal
+            with connection:
+                for table, rows in inserts.items():
+                    dal.insert_many(connection, table, self._convert(table, rows))
+                for table, rows in merges.items():
+                    dal.insert_many(
+                        connection,
+                        table,
+                        self._convert(table, list(rows.values())),
+                        key=self._primary_key(table),
+                    )
+        io_after = writes.io_written()
+        if io_before is not None and io_after is not None:
+            written = io_after - io_before
+        else:
+            written = max(dal.DB_PATH.stat().st_size - size_before, 0)
+        writes.account(writes.DATABASE, written, syncs=1)
+        file.unlink()
+        return len(entries)
+
+    def flush(self) -> int:
+        """
+        Journal in die Datenbank schreiben.
+
+        Gibt die Anzahl der geschriebenen Datensätze zurück.
+        """
+        with self.flush_lock:
+            written = 0
+            # Reste eines abgebrochenen Schreibvorgangs zuerst
+            if self.flush_file.exists():
+                written += self._write(self.flush_file)
+            self._rotate()
+            if self.flush_file.exists():
+                written += self._write(self.flush_file)
+            self.flushed_file.touch()
+            log.info(f"{written} Datensätze aus dem Journal gespeichert")
+            return written
+
+    def recover(self) -> None:
+        """
+        Einträge eines vorherigen Laufs in die Datenbank schreiben.
+        """
+        with self.flush_lock:
+            for file in (self.flush_file, self.journal_file):
+                if file.exists():
+                    log.info(f"Stelle Journal {file} wieder her")
+                    self._write(file)
+
+    def request_flush(self) -> None:
+        """
+        Vorzeitiges Schreiben des Journals anstoßen.
+        """
+        self.flush_event.set()
+
+    def run(self) -> None:
+        while True:
+            stretch = writes.stretch_factor(self.write_budget)
+            if stretch > 1:
+                log.info(f"Schreibbudget überschritten, Intervall x{stretch:.1f}")
+            self.flush_event.wait(self.flush_interval * stretch)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Journal konnte nicht gespeichert werden: {e!r}")
+                time.sleep(10)
+
+    def start(self) -> Thread:
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
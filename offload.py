@@ -0,0 +1,186 @@
+"""
+Rechenintensive Auswertungen in eigenen Prozessen.
+
+Exporte, Downsampling und Aggregationen laufen in Kindprozessen, damit
+sie das GIL von api.py nicht belegen und das Dashboard während eines
+großen Downloads reagiert. Die Ergebnisse kommen blockweise über eine
+Pipe zurück, ein langsamer Client bremst also auch den Kindprozess.
+Trennt der Client die Verbindung, wird der Kindprozess beendet.
+Höchstens MAX_JOBS Aufgaben laufen gleichzeitig, weitere warten.
+
+Die Prozesse startet ein Forkserver, der die Module einmal lädt und
+weder die Threads noch die Datenbankverbindungen von api.py erbt.
+Jede Aufgabe bekommt als erstes Argument eine eigene Session.
+"""
+import asyncio
+import multiprocessing
+import threading
+from contextlib import asynccontextmanager
+from multiprocessing import forkserver
+from types import GeneratorType
+from typing import Any, AsyncIterator, Callable, Iterator
+
+import database
+
+MAX_JOBS = 2
+BATCH_SIZE = 64 * 1024
+WAIT_INTERVAL = 0.1
+PRELOAD = ["__main__", "database", "statistiken", "aggregation", "archive"]
+# Nachrichten des Kindprozesses: (Art, Inhalt)
+CHUNK, RESULT, ERROR, END = range(4)
+
+context = multiprocessing.get_context("forkserver")
+slots = threading.BoundedSemaphore(MAX_JOBS)
+
+
+def start(jobs: int = MAX_JOBS) -> None:
+    """
+    Forkserver starten, damit der erste Export nicht auf das Laden
+    der Module wartet.
+    """
+    global slots
+    slots = threading.BoundedSemaphore(jobs)
+    context.set_forkserver_preload(PRELOAD)
+    forkserver.ensure_running()
+
+
+def _join(batch: list):
+    return b"".join(batch) if isinstance(batch[0], bytes) else "".join(batch)
+
+
+def _run(connection, function: Callable, args: tuple, kwargs: dict) -> None:
+    # läuft im Kindprozess
+    session = database.ReadSession()
+    try:
+        result = function(session, *args, **kwargs)
+        if isinstance(result, GeneratorType):
+            batch, size = [], 0
+            for chunk in result:
+                batch.append(chunk)
+                size += len(chunk)
+                if size >= BATCH_SIZE:
+                    connection.send((CHUNK, _join(batch)))
+                    batch, size = [], 0
+            if batch:
+                connection.send((CHUNK, _join(batch)))
+            connection.send((END, None))
+        else:
+            connection.send((RESULT, result))
+    except Exception as error:
+        try:
+            connection.send((ERROR, error))
+        except Exception:
+            connection.send((ERROR, RuntimeError(repr(error))))
+    finally:
+        session.close()
+        connection.close()
+
+
+def _start(function: Callable, args: tuple, kwargs: dict):
+    reader, writer = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run, args=(writer, function, args, kwargs), daemon=True
+    )
+    process.start()
+    # nur der Kindprozess schreibt, sein Ende wird als EOF sichtbar
+    writer.close()
+    return process, reader
+
+
+def _stop(process, reader) -> None:
+    reader.close()
+    if process.is_alive():
+        process.terminate()
+        process.join(1)
+        if process.is_alive():
+            process.kill()
+    process.join()
+    process.close()
+
+
+def _unpack(message: tuple) -> tuple:
+    kind, payload = message
+    if kind == ERROR:
+        raise payload
+    return kind, payload
+
+
+@asynccontextmanager
+async def slot():
+    """
+    Auf einen freien Platz für eine Aufgabe warten.
+    """
+    while not slots.acquire(blocking=False):
+        await asyncio.sleep(WAIT_INTERVAL)
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+async def _receive(reader, function: Callable) -> tuple:
+    loop = asyncio.get_event_loop()
+    while not reader.poll():
+        ready = loop.create_future()
+        loop.add_reader(reader.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(reader.fileno())
+    try:
+        return _unpack(reader.recv())
+    except EOFError:
+        raise RuntimeError(f"{function.__name__} wurde unerwartet beendet")
+
+
+async def stream(function: Callable, *args, **kwargs) -> AsyncIterator:
+    """
+    Blöcke des Generators function(session, *args, **kwargs)
+    aus einem Kindprozess.
+
+    Wird der Iterator abgebrochen, z. B. weil der Client die Verbindung
+    getrennt hat, wird der Kindprozess beendet.
+    """
+    async with slot():
+        process, reader = _start(function, args, kwargs)
+        try:
+            while True:
+                kind, payload = await _receive(reader, function)
+                if kind != CHUNK:
+                    break
+                yield payload
+        finally:
+            _stop(process, reader)
+
+
+async def run(function: Callable, *args, **kwargs) -> Any:
+    """
+    Ergebnis von function(session, *args, **kwargs) aus einem Kindprozess.
+    """
+    async with slot():
+        process, reader = _start(function, args, kwargs)
+        try:
+            _, result = await _receive(reader, function)
+            return result
+        finally:
+            _stop(process, reader)
+
+
+def iterate(function: Callable, *args, **kwargs) -> Iterator:
+    """
+    Wie stream, aber blockierend für Threads.
+
+    Der Platz muss vorher mit slot() belegt werden.
+    """
+    process, reader = _start(function, args, kwargs)
+    try:
+        while True:
+            try:
+                kind, payload = _unpack(reader.recv())
+            except EOFError:
+                raise RuntimeError(f"{function.__name__} wurde unerwartet beendet")
+            if kind != CHUNK:
+                break
+            yield payload
+    finally:
+        _stop(process, reader)
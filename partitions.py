@@ -0,0 +1,192 @@
+"""
+Partitionierung der Statistik-Datenbank.
+
+Abgeschlossene Zyklen werden aus der aktiven Datenbank in
+versiegelte, kompaktierte Partitionsdateien verschoben.
+Ein kleiner Index (JSON) hält die Zyklen- und Zeitbereiche
+jeder Partition, damit Abfragen direkt die richtige Datei öffnen.
+"""
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+PARTITION_PATH = Path("/media/data/partitions")
+INDEX_FILE = PARTITION_PATH / "index.json"
+
+
+def load_index() -> List[dict]:
+    """
+    Return all sealed partitions, the oldest first.
+    """
+    try:
+        index = json.loads(INDEX_FILE.read_text())
+    except (FileNotFoundError, ValueError):
+        return []
+    return sorted(index, key=lambda entry: entry["first_cycle"])
+
+
+def save_index(index: List[dict]) -> None:
+    tmp_file = INDEX_FILE.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(index))
+    tmp_file.replace(INDEX_FILE)
+
+
+def partition_file(entry: dict) -> Path:
+    return PARTITION_PATH / entry["file"]
+
+
+def last_cycle() -> int:
+    """
+    Return the highest cycle number of all sealed partitions
+    """
+    return max((entry["last_cycle"] for entry in load_index()), default=0)
+
+
+def find(cycle: int) -> Optional[Path]:
+    """
+    Return the partition file, which contains the cycle.
+    """
+    for entry in reversed(load_index()):
+        if entry["first_cycle"] <= cycle <= entry["last_cycle"]:
+            return partition_file(entry)
+    return None
+
+
+# cycles and timestamps of the rows, the compressed cycles and the cycle starts
+RANGE_SOURCES = {
+    "statistik": ("SELECT cycle, timestamp FROM statistik",),
+    "cycle_block": (
+        "SELECT cycle, start FROM cycle_block",
+        'SELECT cycle, "end" FROM cycle_block',
+    ),
+    "cycle": ("SELECT cycle, timestamp FROM cycle",),
+}
+
+
+def _data_range(con: sqlite3.Connection) -> tuple:
+    """
+    Return the first and last cycle and the first and last timestamp
+    of the data in the database or four times None.
+    """
+    tables = {name for (name,) in con.execute("SELECT name FROM sqlite_master")}
+    selects = [
+        select
+        for table, queries in RANGE_SOURCES.items()
+        if table in tables
+        for select in queries
+    ]
+    if not selects:
+        return None, None, None, None
+    return con.execute(
+        "SELECT MIN(cycle), MAX(cycle), MIN(timestamp), MAX(timestamp) "
+        f"FROM ({' UNION ALL '.join(selects)})"
+    ).fetchone()
+
+
+def needs_seal(db_path: Path, size_limit: int) -> bool:
+    """
+    Check if the database should be sealed.
+
+    This is the case if the file is bigger than size_limit
+    in MiB or if the oldest data is from a previous month.
+    """
+    if not db_path.exists():
+        return False
+    if db_path.stat().st_size > size_limit * 1024 ** 2:
+        return True
+    with closing(sqlite3.connect(str(db_path))) as con:
+        try:
+            _, _, start, _ = _data_range(con)
+        except sqlite3.DatabaseError:
+            return False
+    return start is not None and start[:7] != datetime.utcnow().strftime("%Y-%m")
+
+
+def seal(db_path: Path) -> Optional[dict]:
+    """
+    Copy the database compacted into a read-only partition file
+    and remove the database afterwards.
+
+    The caller must ensure, that no process is writing to db_path.
+    """
+    with closing(sqlite3.connect(str(db_path))) as con:
+        try:
+            first_cycle, last_cycle, start, end = _data_range(con)
+        except sqlite3.DatabaseError:
+            return None
+        if first_cycle is None:
+            return None
+        PARTITION_PATH.mkdir(parents=True, exist_ok=True)
+        target = PARTITION_PATH / f"stats-{first_cycle:06d}-{last_cycle:06d}.sqlite"
+        if target.exists():
+            target.unlink()
+        con.execute("VACUUM INTO ?", (str(target),))
+    target.chmod(0o444)
+    entry = {
+        "file": target.name,
+        "first_cycle": first_cycle,
+        "last_cycle": last_cycle,
+        "start": start,
+        "end": end,
+        "size": target.stat().st_size,
+    }
+    index = [item for item in load_index() if item["file"] != target.name]
+    save_index(index + [entry])
+    db_path.unlink()
+    return entry
+
+
+def prune(size_limit: int, reserved: int = 0) -> List[dict]:
+    """
+    Delete the oldest partitions until all partitions together
+    with reserved bytes fit into size_limit in MiB.
+    """
+    index = load_index()
+    removed = []
+    size_limit *= 1024 ** 2
+    while index and sum(entry["size"] for entry in index) + reserved > size_limit:
+        entry = index.pop(0)
+        try:
+            partition_file(entry).unlink()
+        except FileNotFoundError:
+            pass
+        removed.append(entry)
+    if removed:
+        save_index(index)
+    return removed
+
+
+def carry_over(db_path: Path, table: str) -> int:
+    """
+    Copy the rows of table from the newest partition into the database,
+    if the table is still empty there.
+
+    Rows of already pruned cycles are skipped,
+    rows of cycle 0 (lifetime) are always copied.
+    """
+    index = load_index()
+    if not index:
+        return 0
+    source = partition_file(index[-1])
+    with closing(sqlite3.connect(str(db_path))) as con:
+        if con.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+            return 0
+        with closing(sqlite3.connect(f"file:{source}?mode=ro", uri=True)) as sealed:
+            try:
+                cursor = sealed.execute(
+                    f"SELECT * FROM {table} WHERE cycle >= ? OR cycle = 0",
+                    (index[0]["first_cycle"],),
+                )
+            except sqlite3.DatabaseError:
+                return 0
+            columns = ", ".join(column[0] for column in cursor.description)
+            placeholders = ", ".join("?" * len(cursor.description))
+            rows = cursor.fetchall()
+        with con:
+            con.executemany(
+                f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", rows
+            )
+    return len(rows)
@@ -3,12 +3,16 @@ from __future__ import annotations
 
 import json
 import math
+import os
+import signal
 import statistics
 import struct
 import time
 from argparse import ArgumentParser
 from collections import deque
+from datetime import datetime
 from enum import Enum, IntEnum
+from functools import partial
 from itertools import islice
 from logging import DEBUG, INFO, basicConfig, getLogger
 from queue import Empty as QueueEmpty
@@ -21,11 +25,41 @@ import RPi.GPIO as GPIO
 import serial
 import zmq
 
+import aggregates
+import balance
+import capture
+import catalogue
+import compression
+import energy
 import errors
+import health
+import histograms
+import journal
 import notify
 import timedaemon
+import writes
 from current_values import set_values as set_current_values
-from database import Configuration, Error, Session, State, Statistik, set_cycle
+from database import (
+    LIFETIME,
+    Capture,
+    CellBalance,
+    Configuration,
+    CycleHealth,
+    CycleHistogram,
+    CycleSummary,
+    Energy,
+    Error,
+    ErrorEvent,
+    Session,
+    State,
+    Statistik,
+    TimeOffset,
+    get_energy,
+    get_histogram,
+    get_last_error_event_id,
+    init_database,
+    set_cycle,
+)
 
 TXD_EN = 17  # /Transmit Data Enable
 TXD_SENSE = 22  # Receive Data Sense
@@ -91,19 +125,22 @@ class QueryScheduler:
         self.waiting = self._next_in_queue()
         return current_queries
 
-    def switch(self, mode):
+    def switch(self, mode, timeout: Optional[float] = None):
         if self.first_run:
             return
         if mode == self.LIVE:
-            self.normal_after = time.monotonic() + self.live_timeout
+            # a running capture must not be shortened
+            self.normal_after = max(
+                self.normal_after, time.monotonic() + (timeout or self.live_timeout)
+            )
         if self.mode != mode:
             self.mode = mode
             self.waiting = self._next_in_waiting()
             if mode == self.LIVE:
                 log.info(f"Switch mode to {mode}")
 
-    def live(self):
-        self.switch(self.LIVE)
+    def live(self, timeout: Optional[float] = None):
+        self.switch(self.LIVE, timeout)
 
 
 class Frame(IntEnum):
@@ -400,23 +437,36 @@ class Property:
 
 class DataReader(Thread):
     last_error = Property(2, 0.8, str)
-    last_error_flags = Property(2, 0.8, int)
 
     def __init__(
         self,
         answer_queue: ManyQueue,
         queries: QueryScheduler,
         *,
+        journal: journal.Journal,
         cells: int = 4,
         charge_warn_limit: int = 15,
         charge_off_limit: int = 10,
     ):
         self.timedelta_queue: Queue
+        self.journal = journal
         self.answer_queue: ManyQueue = answer_queue
         self.cells: int = cells
         self.queries: QueryScheduler = queries
         self.session = Session()
         self.cycle: int = set_cycle(self.session)
+        self.catalogue = catalogue.CycleCatalogue(self.cycle)
+        self.health = health.HealthTracker(self.cycle)
+        self.balance = balance.BalanceTracker(self.cycle)
+        self.histograms = histograms.HistogramTracker(
+            self.cycle, get_histogram(self.session, LIFETIME)
+        )
+        self.error_event_id: int = get_last_error_event_id(self.session)
+        self.error_events: dict = {}
+        self.error_flags: int = 0
+        self.energy = energy.EnergyCounter(
+            energy.Throughput.from_row(get_energy(self.session, LIFETIME))
+        )
         self.last_answer: float = 0.0
         self.error_topics: list = [
             0x0010,
@@ -444,6 +494,15 @@ class DataReader(Thread):
         self.db_next_update: float = time.monotonic() + 120
         self.start_time: float = time.monotonic()
         self.stats_current: deque = deque(maxlen=4)
+        self.aggregates = aggregates.IntervalAggregates()
+        self.capture = capture.CaptureRecorder(
+            pre_trigger=global_settings.get("capture_pre_trigger", 30),
+            post_trigger=global_settings.get("capture_post_trigger", 60),
+        )
+        self.capture_current_limit: Optional[float] = global_settings.get(
+            "capture_current_limit"
+        )
+        self.over_current_limit: bool = False
         self.stats_charge: deque = deque(maxlen=4)
         self.notified: bool = False
         self.charge_warn_limit = charge_warn_limit
@@ -454,15 +513,76 @@ class DataReader(Thread):
         """
         Fehlerbehandlung
         """
-        if error_flags != self.last_error_flags:
-            self.last_error_flags = error_flags
-            self.current_values["error"] = self.last_error_flags
-            self.session.add(Error(row=self.row, cycle=self.cycle, error=self.last_error_flags))
-            error_text = errors.get_msg(self.last_error_flags, err_topics=self.error_topics)
+        if error_flags != self.error_flags:
+            # nur neu gesetzte Bits zählen und lösen eine Aufzeichnung aus
+            new_flags = error_flags & ~self.error_flags
+            self.error_flags = error_flags
+            self.current_values["error"] = error_flags
+            self.journal.add(Error, row=self.row, cycle=self.cycle, error=error_flags)
+            self.track_error_events(error_flags)
+            self.capture.add("error", error_flags, time.monotonic())
+            if new_flags:
+                self.catalogue.add_error()
+                self.trigger_capture(f"Fehler 0x{new_flags:04X}")
+            error_text = errors.get_msg(error_flags, err_topics=self.error_topics)
             if error_text and error_text != self.last_error:
                 self.last_error = error_text
                 Thread(target=notify.send_report, args=(error_text,)).start()
 
+    def track_error_events(self, error_flags: int) -> None:
+        """
+        Setzen und Zurücksetzen der einzelnen Fehlerbits speichern.
+        """
+        timestamp = datetime.utcnow()
+        for bit in errors.error_mapping:
+            event = self.error_events.get(bit)
+            if error_flags & bit and event is None:
+                self.error_event_id += 1
+                event = {
+                    "id": self.error_event_id,
+                    "cycle": self.cycle,
+                    "bit": bit,
+                    "set_row": self.row,
+                    "set_timestamp": timestamp,
+                }
+                self.error_events[bit] = event
+                self.journal.merge(ErrorEvent, **event)
+            elif not error_flags & bit and event is not None:
+                del self.error_events[bit]
+                event.update(cleared_row=self.row, cleared_timestamp=timestamp)
+                self.journal.merge(ErrorEvent, **event)
+
+    def trigger_capture(self, reason: str) -> None:
+        """
+        Aufzeichnung starten und für die Dauer mit maximaler Rate abfragen.
+        """
+        log.info(f"Starte Aufzeichnung: {reason}")
+        seconds = self.capture.trigger(reason, time.monotonic())
+        self.queries.live(seconds)
+
+    def check_current_limit(self, current: float) -> None:
+        """
+        Aufzeichnung auslösen, wenn der Betrag des Stroms
+        den Grenzwert überschreitet.
+        """
+        if not self.capture_current_limit:
+            return
+        over_limit = abs(current) > self.capture_current_limit
+        if over_limit and not self.over_current_limit:
+            self.trigger_capture(f"Strom {current:.1f} A")
+        self.over_current_limit = over_limit
+
+    def store_capture(self) -> None:
+        """
+        Abgeschlossene Aufzeichnung speichern.
+        """
+        finished = self.capture.poll(time.monotonic())
+        if finished is None:
+            return
+        log.info(f"Speichere Aufzeichnung mit {finished['samples']} Messwerten")
+        self.journal.add(Capture, cycle=self.cycle, row=self.row, **finished)
+        self.journal.request_flush()
+
     def update_current_values(self) -> None:
         current_data = (
             self.row,
@@ -477,6 +597,14 @@ class DataReader(Thread):
             time.time(),
             self.current_values["lower_cell_voltage"],
             self.current_values["upper_cell_voltage"],
+            self.energy.cycle.ah_in,
+            self.energy.cycle.ah_out,
+            self.energy.cycle.wh_in,
+            self.energy.cycle.wh_out,
+            self.energy.lifetime.ah_in,
+            self.energy.lifetime.ah_out,
+            self.energy.lifetime.wh_in,
+            self.energy.lifetime.wh_out,
             *self.current_values["cell_voltages"],
         )
         set_current_values(current_data)
@@ -485,25 +613,21 @@ class DataReader(Thread):
         """
         Prüfe ob es Sprünge in der Zeit gab.
 
-        Anschließende Korrektur der Zeitstempel.
+        Die Korrektur wird als Offset für alle bisherigen Zeilen
+        des Zyklus gespeichert und erst beim Lesen angewendet.
         """
         diff: timedaemon.timedelta
         positive: float
         if not self.timedelta_queue.empty():
             log.info(
-                f"Die Systemzeit hat sich geändert. Aktualisiere die Daten aus dem Zyklus {self.cycle}"
+                f"Die Systemzeit hat sich geändert. Korrigiere die Daten aus dem Zyklus {self.cycle}"
             )
             diff, positive = self.timedelta_queue.get()
-            # den Zyklus und alle Zeilen < self.row müssen aktualisiert werden
-            for stat in self.session.query(Statistik).filter(
-                Statistik.cycle == self.cycle, Statistik.row < self.row
-            ):
-                if positive:
-                    corrected_timestamp = stat.timestamp + diff
-                else:
-                    corrected_timestamp = stat.timestamp - diff
-                stat.timestamp = corrected_timestamp
-                self.session.merge(stat)
+            delta = diff.total_seconds() if positive else -diff.total_seconds()
+            # den Zyklus und alle Zeilen < self.row müssen korrigiert werden
+            self.journal.add(
+                TimeOffset, cycle=self.cycle, row_from=0, row_to=self.row, delta=delta
+            )
 
     def run(self) -> None:
         """
@@ -524,6 +648,7 @@ class DataReader(Thread):
             self.send_queries(queries)
             self.handle_queries()
             self.database_insert()
+            self.store_capture()
             self.check_alert()
             # time.sleep(0.1)
 
@@ -582,6 +707,7 @@ class DataReader(Thread):
                     )
                     notify_thread.start()
                     self.notified = True
+                    self.journal.request_flush()
                 elif relative_load < off_limit:
                     notify.send_report(
                         f"Die Ladung des Akkus ist unter {self.charge_off_limit}%. Das Wlan-Modul wird heruntergefahren."
@@ -589,8 +715,10 @@ class DataReader(Thread):
                     log.warning(f"Achtung Ladung: {relative_load:.1f} %")
                     self.power_off()
 
-    @staticmethod
-    def power_off():
+    def power_off(self):
+        # Journal sichern, bevor das WLAN-Modul abgeschaltet wird
+        self.journal.flush()
+        writes.persist()
         GPIO.setup(5, GPIO.OUT)
         GPIO.output(5, True)
         time.sleep(2)
@@ -611,19 +739,43 @@ class DataReader(Thread):
             current_values = self.current_values.copy()
             del current_values["lower_cell_voltage"]
             del current_values["upper_cell_voltage"]
-            try:
-                current_mean = statistics.mean(self.stats_current)
-            except statistics.StatisticsError:
-                pass
-            else:
-                current_values["current"] = current_mean
+            # Mittelwerte und Extremwerte seit dem letzten Datensatz
+            current_values.update(self.aggregates.collect(time.monotonic()))
             del current_values["capacity"]  # this key is in a different table
             del current_values["error"]  # this also
-            dataset = Statistik(cycle=self.cycle, row=self.row, **current_values)
-            self.session.add(dataset)
-            self.session.commit()
+            timestamp = datetime.utcnow()
+            # Spreizung und niedrigste/höchste Zelle für die Zeile
+            current_values.update(
+                self.balance.add(timestamp, current_values["cell_voltages"])
+            )
+            self.journal.add(
+                Statistik,
+                cycle=self.cycle,
+                row=self.row,
+                timestamp=timestamp,
+                **current_values,
+            )
+            self.catalogue.add_row(timestamp, current_values)
+            # genauer als die Berechnung aus den gespeicherten Zeilen
+            self.catalogue.ah_in = self.energy.cycle.ah_in
+            self.catalogue.ah_out = self.energy.cycle.ah_out
+            self.journal.merge(CycleSummary, **self.catalogue.to_dict())
+            self.health.add_row(timestamp, current_values)
+            self.health.ah_in = self.energy.cycle.ah_in
+            self.health.ah_out = self.energy.cycle.ah_out
+            self.journal.merge(CycleHealth, **self.health.to_dict())
+            self.journal.merge(CellBalance, **self.balance.to_dict())
+            self.histograms.add_row(timestamp, current_values)
+            self.journal.merge(CycleHistogram, **self.histograms.to_dict())
+            self.journal.merge(
+                CycleHistogram, **self.histograms.lifetime_to_dict(LIFETIME)
+            )
+            self.journal.merge(Energy, cycle=self.cycle, **self.energy.cycle.to_dict())
+            self.journal.merge(Energy, cycle=LIFETIME, **self.energy.lifetime.to_dict())
             self.row += 1
-            self.db_next_update = time.monotonic() + self.db_update_interval
+            # über dem Schreibbudget seltener speichern
+            stretch = writes.stretch_factor(write_budget(global_settings))
+            self.db_next_update = time.monotonic() + self.db_update_interval * stretch
 
     def send_queries(self, queries: List[bytes]) -> None:
         # Prüfe Kapazität
@@ -640,14 +792,23 @@ class DataReader(Thread):
             log.debug(f"Antwort: {frame_type} | Werte: {values}")
             if frame_type is Data.AnswerCapacity:
                 self.current_values["capacity"] = values[0]
+                self.health.capacity = values[0]
+                self.histograms.capacity = values[0]
                 log.info(f"Kapazität: {values[0]}")
-                self.session.add(Configuration(capacity=values[0], cycle=self.cycle))
-                self.session.commit()
+                self.journal.add(Configuration, capacity=values[0], cycle=self.cycle)
             elif frame_type is Data.AnswerVoltage:
                 self.current_values["voltage"] = values[0]
+                self.aggregates.add("voltage", values[0], time.monotonic())
+                self.capture.add("voltage", values[0], time.monotonic())
             elif frame_type is Data.AnswerCurrent:
                 self.current_values["current"] = values[0]
                 self.stats_current.append(values[0])
+                self.aggregates.add("current", values[0], time.monotonic())
+                self.capture.add("current", values[0], time.monotonic())
+                self.check_current_limit(values[0])
+                self.energy.update(
+                    values[0], self.current_values["voltage"], time.monotonic()
+                )
             elif frame_type is Data.AnswerCharge:
                 if global_settings.get("override_charge", False):
                     calculated_charge = calculate_charge(self.current_values["voltage"])
@@ -660,8 +821,16 @@ class DataReader(Thread):
                 else:
                     self.current_values["charge"] = values[0]
                 self.stats_charge.append(values[0])
+                self.aggregates.add(
+                    "charge", self.current_values["charge"], time.monotonic()
+                )
+                self.capture.add(
+                    "charge", self.current_values["charge"], time.monotonic()
+                )
             elif frame_type is Data.AnswerTemperature:
                 self.current_values["temperature"] = values[0]
+                self.aggregates.add("temperature", values[0], time.monotonic())
+                self.capture.add("temperature", values[0], time.monotonic())
             elif frame_type is Data.AnswerCellVoltage:
                 cell_id, cell_voltage = values
                 # if cell_id == 0xFE:
@@ -671,6 +840,7 @@ class DataReader(Thread):
                 # else:
                 try:
                     self.current_values["cell_voltages"][cell_id] = cell_voltage
+                    self.capture.add(f"cell_{cell_id}", cell_voltage, time.monotonic())
                 except IndexError:
                     log.error(f"Zellen-Index {cell_id} ist ungültig")
             elif frame_type is Data.AnswerLowHighCellVoltage:
@@ -683,9 +853,9 @@ class DataReader(Thread):
             elif frame_type is Fault.AnswerErrorFlags:
                 self.handle_error(values[0])
             elif frame_type is Mode.AnswerSetOff:
-                self.session.add(State(cycle=self.cycle, row=self.row, onoff=False))
+                self.journal.add(State, cycle=self.cycle, row=self.row, onoff=False)
             elif frame_type is Mode.AnswerSetOn:
-                self.session.add(State(cycle=self.cycle, row=self.row, onoff=True))
+                self.journal.add(State, cycle=self.cycle, row=self.row, onoff=True)
         self.update_current_values()
         self.last_answer = time.monotonic()
 
@@ -697,6 +867,7 @@ class Commands(Enum):
     reset = b"reset"
     ack = b"ack"
     live = b"LIVE"
+    flush = b"flush"
 
 
 class Priority(IntEnum):
@@ -795,6 +966,8 @@ class CommandLoop(Thread):
                 send_command(set_reset_alarm())
             elif cmd == Commands.live.value:
                 query_scheduler.live()
+            elif cmd == Commands.flush.value:
+                data_journal.request_flush()
 
 
 class SerialTxLock:
@@ -1140,6 +1313,26 @@ def setup_gpio():
     GPIO.setup(TXD_SENSE, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # /Transmit Data Sense
 
 
+def write_budget(settings: dict) -> Optional[float]:
+    """
+    Schreibbudget in Bytes pro Tag, None ohne Budget
+    """
+    budget = settings.get("write_budget_mb")
+    if not budget:
+        return None
+    return budget * 1024 ** 2
+
+
+def stop(data_journal: journal.Journal, signum, frame):
+    """
+    Journal beim Beenden des Dienstes speichern.
+    """
+    log.info("Beende Server und speichere das Journal")
+    data_journal.flush()
+    writes.persist()
+    os._exit(0)
+
+
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument("-d", action="store_true", help="Debug Modus")
@@ -1148,6 +1341,7 @@ def parse_args():
 
 
 basicConfig(level=INFO)
+getLogger().addHandler(writes.LogCounter())
 log = getLogger("Server")
 serial_sender_queue = ManyPriorityQueue()
 serial_receiver_queue = ManyQueue()
@@ -1226,6 +1420,25 @@ if __name__ == "__main__":
     else:
         log.setLevel(INFO)
     if not args.p:
+        # das Journal des vorherigen Laufs vor dem Versiegeln speichern,
+        # sonst landen seine Zeilen hinter der Partition in der neuen Datenbank
+        log.info("Starte Journal")
+        data_journal = journal.Journal(
+            flush_interval=global_settings.get(
+                "journal_flush_interval", journal.FLUSH_INTERVAL
+            ),
+            write_budget=write_budget(global_settings),
+        )
+
+        log.info("Initialisiere Datenbank")
+        if init_database():
+            log.info("Datenbankschema aktualisiert")
+
+        # nach dem Versiegeln und vor allen Threads,
+        # der Prozess wird mit fork gestartet
+        log.info("Starte Komprimierung abgeschlossener Zyklen")
+        compression.start_compactor()
+
         log.info("Starte QueryScheduler")
         query_scheduler = QueryScheduler(*get_queries(global_settings))
 
@@ -1245,12 +1458,17 @@ if __name__ == "__main__":
         command_server = CommandLoop(addr="tcp://127.0.0.1:4000")
         command_server.start()
 
+        data_journal.start()
+        signal.signal(signal.SIGTERM, partial(stop, data_journal))
+
         log.info("Starte Datenlogger")
 
         data_logger = DataReader(
             serial_receiver_queue,
             query_scheduler,
+            journal=data_journal,
             charge_warn_limit=charge_warn_limit,
             charge_off_limit=charge_off_limit,
         )
         data_logger.start()
+
@@ -6,6 +6,8 @@ from pathlib import Path
 from subprocess import call
 from contextlib import contextmanager
 
+import writes
+
 # from python_hosts import Hosts, HostsEntry
 
 
@@ -61,7 +63,7 @@ def set_ap(host_name: str):
         r"^ssid=(.*)", name, hostapd_conf.read_text(), flags=re.MULTILINE,
     )
     try:
-        hostapd_conf.write_text(new_config)
+        writes.write_text(hostapd_conf, new_config)
     except PermissionError:
         pass
 
@@ -73,6 +75,7 @@ def set_hostname(host_name: str):
     with read_write():
         with open("/etc/hostname", "w") as fd:
             fd.write(host_name + "\n")
+    writes.account(writes.CONFIG, len(host_name) + 1)
 
 
 def set_hostname_dhclient(hostname: str):
@@ -84,7 +87,7 @@ def set_hostname_dhclient(hostname: str):
     if result:
         new = regex.sub(fmt.format(hostname), config.read_text())
         if new != old:
-            config.write_text(new)
+            writes.write_text(config, new)
 
 
 def set_hosts(hostname: str):
@@ -104,6 +107,7 @@ def set_hosts(hostname: str):
     hosts_file.add([entry])
     with read_write():
         hosts_file.write()
+    writes.account(writes.CONFIG, Path(hosts_file.hosts_path).stat().st_size)
 
 
 def set_hostname_kernel(name: str):
@@ -1,29 +1,266 @@
 import datetime
+import json
+import math
+import struct
+from array import array
+from itertools import islice
 from pathlib import Path
-from typing import Generator, Optional
+from typing import Any, Callable, Generator, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
 
 try:
     from zoneinfo import ZoneInfo
 except ImportError:
     from backports.zoneinfo import ZoneInfo
 
+import compression
+import dal
+import downsampling
+import errors
 from database import (
     Session,
-    Statistik,
     Configuration,
     desc,
+    get_cycle_block,
+    get_cycles_in_range,
+    get_error_events,
+    get_path,
+    get_session,
+    get_time_offsets,
 )
 
+# rows per chunk of the export
+CHUNK_SIZE = 500
+CHANNELS = ("voltage", "current", "charge", "temperature")
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+NAN = float("nan")
+BINARY_MAGIC = b"AKST"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBBH")
 timezone_file = Path("/etc/timezone")
 tz = ZoneInfo(timezone_file.read_text().strip())
 
 
+def time_offset(offsets: List[Tuple[int, int, float]], row: int) -> datetime.timedelta:
+    """
+    Summe der Zeitkorrekturen, die für die Zeile gelten.
+    """
+    return datetime.timedelta(
+        seconds=sum(
+            delta for row_from, row_to, delta in offsets if row_from <= row < row_to
+        )
+    )
+
+
+def local_delta(timestamp: datetime.datetime) -> datetime.timedelta:
+    """
+    Differenz zwischen dem gespeicherten und dem exportierten Zeitstempel.
+    """
+    return timestamp.astimezone(tz).replace(tzinfo=None) - timestamp
+
+
+def iter_chunks(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_round_func(rounding: Optional[int]) -> Callable:
+    if rounding is None:
+        return lambda x: x
+    return lambda x: x if x is None else round(x, rounding)
+
+
+def last_row(session: Session, cycle: int) -> Optional[int]:
+    """
+    Nummer der letzten gespeicherten Zeile eines Zyklus, der Cursor
+    für since_row.
+    """
+    with get_session(session, cycle) as cycle_session:
+        block = get_cycle_block(cycle_session, cycle)
+    if block is not None:
+        return block.first_row + block.row_count - 1 if block.row_count else None
+    return dal.last_row(get_path(cycle), cycle)
+
+
+def parse_since(timestamp: datetime.datetime) -> datetime.datetime:
+    """
+    Zeitstempel since_ts nach UTC.
+
+    Ohne Zeitzone gilt die Ortszeit, wie in den exportierten Zeitstempeln.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=tz)
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def iter_export(
+    session: Session,
+    cycle: int,
+    history: Optional[float] = None,
+    now: Optional[datetime.datetime] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    until_ts: Optional[datetime.datetime] = None,
+) -> Iterator[List[Tuple[datetime.datetime, Any, int]]]:
+    """
+    Zeilen eines Zyklus in Blöcken von CHUNK_SIZE Zeilen
+    als (korrigierter Zeitstempel UTC, Zeile, Zyklus).
+
+    history zählt die Stunden vor now zurück. since_row und until_row
+    begrenzen die Nummern der Zeilen auf (since_row, until_row],
+    since_ts und until_ts (UTC) die Zeitstempel auf (since_ts, until_ts].
+    """
+    # closed cycles could be sealed into a partition
+    with get_session(session, cycle) as cycle_session:
+        offsets = get_time_offsets(cycle_session, cycle)
+        block = get_cycle_block(cycle_session, cycle)
+    start = None
+    if history is not None:
+        now = now or datetime.datetime.utcnow()
+        start = now - datetime.timedelta(hours=history)
+    if since_ts is not None:
+        start = since_ts if start is None else max(start, since_ts)
+    if block is not None:
+        # closed cycles are compressed and filtered while decoding
+        query = (
+            row
+            for row in compression.iter_rows(block)
+            if (since_row is None or row.row > since_row)
+            and (until_row is None or row.row <= until_row)
+        )
+    else:
+        # the stored timestamps are not corrected yet
+        since = until = None
+        if start is not None:
+            lookbehind = sum(max(delta, 0) for *_, delta in offsets)
+            since = start - datetime.timedelta(seconds=lookbehind)
+        if until_ts is not None:
+            lookahead = sum(max(-delta, 0) for *_, delta in offsets)
+            until = until_ts + datetime.timedelta(seconds=lookahead)
+        query = dal.read_statistik(
+            get_path(cycle), cycle, since, since_row, until_row, until
+        )
+    for chunk in iter_chunks(query, CHUNK_SIZE):
+        rows = []
+        for row in chunk:
+            timestamp = row.timestamp
+            if offsets:
+                timestamp += time_offset(offsets, row.row)
+            if start is not None and timestamp <= start:
+                continue
+            if until_ts is not None and timestamp > until_ts:
+                continue
+            rows.append((timestamp, row, cycle))
+        if rows:
+            yield rows
+
+
+def iter_range(
+    session: Session, start: datetime.datetime, end: datetime.datetime
+) -> Iterator[List[Tuple[datetime.datetime, Any, int]]]:
+    """
+    Zeilen aller Zyklen zwischen start und end (UTC) wie iter_export.
+
+    Die Zyklen kommen aus dem Katalog. Sie überschneiden sich zeitlich
+    nicht und werden nacheinander gelesen, es ist immer nur ein Zyklus
+    geöffnet.
+    """
+    for cycle in get_cycles_in_range(session, start, end):
+        yield from iter_export(session, cycle, since_ts=start, until_ts=end)
+
+
+def iter_selected(
+    session: Session,
+    cycle: Optional[int],
+    history: Optional[float] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    now: Optional[datetime.datetime] = None,
+) -> Iterator[List[Tuple[datetime.datetime, Any, int]]]:
+    """
+    Wie iter_export, mit points werden die Kanäle mit LTTB
+    auf höchstens points Punkte je Kanal reduziert.
+    Ohne cycle werden alle Zyklen von start bis end gelesen (iter_range).
+
+    Dafür werden die Zeilen zweimal gelesen, dazwischen liegen
+    nur die Kanäle als Arrays im Speicher.
+    """
+
+    def read(now: Optional[datetime.datetime] = None):
+        if cycle is None:
+            return iter_range(session, start, end)
+        return iter_export(session, cycle, history, now, since_row, until_row, since_ts)
+
+    if points is None:
+        yield from read(now)
+        return
+    now = now or datetime.datetime.utcnow()
+    timestamps = array("d")
+    channels = [array("d") for _ in CHANNELS]
+    for rows in read(now):
+        for timestamp, row, _ in rows:
+            timestamps.append((timestamp - EPOCH) / SECOND)
+            for channel, values in zip(CHANNELS, channels):
+                value = getattr(row, channel)
+                values.append(NAN if value is None else value)
+    count = len(timestamps)
+    selected = np.zeros(count, dtype=bool)
+    selected[
+        downsampling.select(
+            np.frombuffer(timestamps),
+            [np.frombuffer(values) for values in channels],
+            points,
+        )
+    ] = True
+    index = 0
+    for rows in read(now):
+        chunk = []
+        for item in rows:
+            # rows added since the first pass are skipped
+            if index < count and selected[index]:
+                chunk.append(item)
+            index += 1
+        if chunk:
+            yield chunk
+
+
+def local_times(
+    rows: List[Tuple[datetime.datetime, Any, int]],
+) -> List[datetime.datetime]:
+    """
+    Exportierte Zeitstempel eines Blocks.
+    """
+    # the offset to local time changes at most once in a chunk
+    delta = local_delta(rows[0][0])
+    if delta != local_delta(rows[-1][0]):
+        return [timestamp.astimezone(tz).replace(tzinfo=None) for timestamp, *_ in rows]
+    return [timestamp + delta for timestamp, *_ in rows]
+
+
 def get_stats(
-    session: Session, cycle: int, history: Optional[float] = None, rounding: Optional[int] = None
+    session: Session,
+    cycle: Optional[int],
+    history: Optional[float] = None,
+    rounding: Optional[int] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
 ) -> Generator[str, None, None]:
-    round_func = (
-        (lambda x: x) if rounding is None else (lambda x: round(x, rounding))
-    )
+    round_func = get_round_func(rounding)
     whitespace = " "
     header = (
         "timestamp",
@@ -33,26 +270,260 @@ def get_stats(
         "temperature",
         "cell_voltages",
     )
+    # over a time range the last column is the cycle of the row
+    ranged = cycle is None
+    if ranged:
+        header += ("cycle",)
     yield ",".join(header) + "\n"
-    if history is not None:
-        start = datetime.datetime.utcnow() - datetime.timedelta(hours=history)
-        query = (
-            session.query(Statistik)
-            .filter(Statistik.cycle == cycle, Statistik.timestamp > start)
-            .all()
+    for rows in iter_selected(
+        session, cycle, history, points, since_row, until_row, since_ts, start, end
+    ):
+        lines = []
+        for local_time, (_, row, row_cycle) in zip(local_times(rows), rows):
+            cell_voltages = str([round_func(v) for v in row.cell_voltages])
+            if whitespace in cell_voltages:
+                cell_voltages = f'"{cell_voltages}"'
+            lines.append(
+                f"{local_time.isoformat()},{round_func(row.voltage)},"
+                f"{round_func(row.current)},{round_func(row.charge)},"
+                f"{round_func(row.temperature)},{cell_voltages}"
+                + (f",{row_cycle}\n" if ranged else "\n")
+            )
+        yield "".join(lines)
+
+
+def get_stats_ndjson(
+    session: Session,
+    cycle: Optional[int],
+    history: Optional[float] = None,
+    rounding: Optional[int] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+) -> Generator[str, None, None]:
+    """
+    Statistiken als ein JSON-Objekt pro Zeile.
+
+    Über einen Zeitraum enthält jedes Objekt den Zyklus.
+    """
+    round_func = get_round_func(rounding)
+    for rows in iter_selected(
+        session, cycle, history, points, since_row, until_row, since_ts, start, end
+    ):
+        lines = []
+        for local_time, (_, row, row_cycle) in zip(local_times(rows), rows):
+            record = {
+                "timestamp": local_time.isoformat(timespec="microseconds"),
+                "voltage": round_func(row.voltage),
+                "current": round_func(row.current),
+                "charge": round_func(row.charge),
+                "temperature": round_func(row.temperature),
+                "cell_voltages": [round_func(v) for v in row.cell_voltages],
+            }
+            if cycle is None:
+                record["cycle"] = row_cycle
+            lines.append(json.dumps(record) + "\n")
+        yield "".join(lines)
+
+
+def _json_value(value: float) -> str:
+    # NaN and infinity are not valid in JSON
+    return repr(value) if math.isfinite(value) else "null"
+
+
+def get_stats_columns(
+    session: Session,
+    cycle: Optional[int],
+    history: Optional[float] = None,
+    rounding: Optional[int] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+) -> Generator[str, None, None]:
+    """
+    Statistiken spaltenweise im Format columns von c3.
+
+    Jede Spalte wird in einem eigenen Durchgang über die Zeilen
+    geschrieben, im Speicher liegt nur ein Block von CHUNK_SIZE Zeilen.
+    Der erste Durchgang begrenzt die Zeilen auf die letzte vorhandene,
+    damit alle Spalten dieselben Zeilen enthalten.
+    Die Zellspannungen folgen als cell_0, cell_1, ...
+    Über einen Zeitraum folgt zuletzt die Spalte cycle.
+    """
+    round_func = get_round_func(rounding)
+    now = datetime.datetime.utcnow()
+    cells = 0
+    last = None
+    for rows in iter_selected(
+        session, cycle, history, None, since_row, until_row, since_ts, start, end, now
+    ):
+        if last is None:
+            cells = len(rows[0][1].cell_voltages)
+        last = rows[-1]
+    if last is not None:
+        # rows stored after the first pass are not part of the export
+        if cycle is None:
+            end = last[0]
+        else:
+            until_row = last[1].row
+
+    def passes() -> Iterator[List[Tuple[datetime.datetime, Any, int]]]:
+        if last is None:
+            return iter(())
+        return iter_selected(
+            session,
+            cycle,
+            history,
+            points,
+            since_row,
+            until_row,
+            since_ts,
+            start,
+            end,
+            now,
         )
-    else:
-        query = session.query(Statistik).filter(Statistik.cycle == cycle).all()
-    for row in query:
-        csv_row = (
-            row.timestamp.astimezone(tz).isoformat()[:-6],
-            round_func(row.voltage),
-            round_func(row.current),
-            round_func(row.charge),
-            round_func(row.temperature),
-            [round_func(v) for v in row.cell_voltages],
+
+    def values(rows: List[Tuple[datetime.datetime, Any, int]], column: int) -> list:
+        if column < len(CHANNELS):
+            return [getattr(row, CHANNELS[column]) for _, row, _ in rows]
+        cell = column - len(CHANNELS)
+        return [
+            row.cell_voltages[cell] if len(row.cell_voltages) > cell else None
+            for _, row, _ in rows
+        ]
+
+    yield '{"columns": [["timestamp"'
+    for rows in passes():
+        yield "".join(
+            f',"{local_time.isoformat(timespec="microseconds")}"'
+            for local_time in local_times(rows)
         )
+    yield "]"
+    names = [*CHANNELS, *(f"cell_{cell}" for cell in range(cells))]
+    for column, name in enumerate(names):
+        yield f', ["{name}"'
+        for rows in passes():
+            yield "".join(
+                "," + ("null" if value is None else _json_value(round_func(value)))
+                for value in values(rows, column)
+            )
+        yield "]"
+    if cycle is None:
+        yield ', ["cycle"'
+        for rows in passes():
+            yield "".join(f",{row_cycle}" for *_, row_cycle in rows)
+        yield "]"
+    yield "]}"
+
 
-        yield ",".join(
-            f'"{col}"' if whitespace in col else f"{col}" for col in map(str, csv_row)
-        ) + "\n"
+def _binary_header(
+    cycle: Optional[int], cells: int
+) -> Generator[bytes, None, struct.Struct]:
+    """
+    Kopf der Binärdaten, gibt das Format einer Zeile zurück.
+    """
+    names = ["timestamp", *CHANNELS, *(f"cell_{cell}" for cell in range(cells))]
+    if cycle is None:
+        names.append("cycle")
+    encoded_names = ",".join(names).encode()
+    yield BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, len(names), len(encoded_names)
+    )
+    yield encoded_names
+    return struct.Struct(f"<d{len(names) - 1}f")
+
+
+def get_stats_binary(
+    session: Session,
+    cycle: Optional[int],
+    history: Optional[float] = None,
+    rounding: Optional[int] = None,
+    points: Optional[int] = None,
+    since_row: Optional[int] = None,
+    until_row: Optional[int] = None,
+    since_ts: Optional[datetime.datetime] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+) -> Generator[bytes, None, None]:
+    """
+    Statistiken als Binärdaten, Little Endian.
+
+    Kopf: b"AKST", Version (uint8), Anzahl der Spalten (uint8),
+    Länge der Spaltennamen (uint16) und die Spaltennamen mit Komma getrennt.
+    Danach je Zeile der Zeitstempel als Sekunden seit 1970 UTC (float64)
+    und die übrigen Spalten als float32, NaN für fehlende Werte.
+    Über einen Zeitraum ist die letzte Spalte der Zyklus.
+    Ohne Zeilen wird nur der Kopf ohne die Spalten der Zellen geliefert.
+    rounding wird nicht verwendet, float32 ist bereits kompakt.
+    """
+    record = None
+    cells = 0
+    for rows in iter_selected(
+        session, cycle, history, points, since_row, until_row, since_ts, start, end
+    ):
+        if record is None:
+            cells = len(rows[0][1].cell_voltages)
+            record = yield from _binary_header(cycle, cells)
+        chunk = bytearray()
+        for timestamp, row, row_cycle in rows:
+            values = [getattr(row, channel) for channel in CHANNELS]
+            values += (list(row.cell_voltages) + [None] * cells)[:cells]
+            if cycle is None:
+                values.append(row_cycle)
+            chunk += record.pack(
+                (timestamp - EPOCH) / SECOND,
+                *(NAN if value is None else value for value in values),
+            )
+        yield bytes(chunk)
+    if record is None:
+        # the number of cells is not known without rows
+        yield from _binary_header(cycle, 0)
+
+
+def get_errors(
+    session: Session,
+    bit: Optional[int] = None,
+    cycle: Optional[int] = None,
+    cursor: Optional[int] = None,
+    limit: int = 100,
+) -> dict:
+    """
+    Seite der Fehlerhistorie mit korrigierten Zeitstempeln.
+    """
+    events = get_error_events(session, bit, cycle, cursor, limit)
+    offsets = {}
+    result = []
+    for event in events:
+        if event.cycle not in offsets:
+            with get_session(session, event.cycle) as cycle_session:
+                offsets[event.cycle] = get_time_offsets(cycle_session, event.cycle)
+        cycle_offsets = offsets[event.cycle]
+        set_timestamp = event.set_timestamp
+        if set_timestamp is not None:
+            set_timestamp += time_offset(cycle_offsets, event.set_row)
+        cleared_timestamp = event.cleared_timestamp
+        if cleared_timestamp is not None:
+            cleared_timestamp += time_offset(cycle_offsets, event.cleared_row)
+        error = errors.error_mapping[event.bit]
+        result.append(
+            {
+                "id": event.id,
+                "cycle": event.cycle,
+                "bit": event.bit,
+                "header": error.header,
+                "type": error.type,
+                "short": error.short,
+                "set_row": event.set_row,
+                "set_timestamp": set_timestamp,
+                "cleared_row": event.cleared_row,
+                "cleared_timestamp": cleared_timestamp,
+            }
+        )
+    next_cursor = events[-1].id if len(events) == limit else None
+    return {"events": result, "next_cursor": next_cursor}
@@ -4,13 +4,15 @@ from argparse import ArgumentParser
 from pathlib import Path
 from subprocess import check_output
 
+import writes
+
 
 def set_ap_pw(pw):
      if len(pw) < 8:
          raise ValueError('Password is too short')
      config = Path('/etc/hostapd/hostapd.conf')
      new_settings = re.sub(r'wpa_passphrase=.+', f'wpa_passphrase={pw}', config.read_text())
-     config.write_text(new_settings)
+     writes.write_text(config, new_settings)
 
 
 def reset():
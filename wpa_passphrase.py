@@ -4,6 +4,8 @@ from binascii import hexlify
 from pathlib import Path
 from hashlib import pbkdf2_hmac
 
+import writes
+
 
 CONFIG = """
 country=de
@@ -32,7 +34,8 @@ def set_network(ssid, password):
         raise ValueError('Passwort ist zu kurz. Mindestens 8 Zeichen.')
     psk = gen_psk(ssid, password)
     wpa_supplicant = Path('/etc/wpa_supplicant/wpa_supplicant.conf')
-    wpa_supplicant.write_text(
+    writes.write_text(
+        wpa_supplicant,
         CONFIG.format(ssid=ssid, psk=psk, password=password)
     )
 
@@ -0,0 +1,165 @@
+"""
+Buchführung über Schreibzugriffe auf die SD-Karte.
+
+Jeder Dienst meldet die geschriebenen Bytes und Synchronisierungen
+je Subsystem (Datenbank, Einstellungen, Konfiguration, Log, Exporte).
+Die Summen je Tag liegen im tmpfs und werden beim Tageswechsel
+auf die SD-Karte übernommen. Mit einem Budget pro Tag werden die
+Intervalle zum Speichern gestreckt, wenn der Verbrauch des Tages
+hochgerechnet über dem Budget liegt.
+"""
+import fcntl
+import json
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from logging import Handler, LogRecord
+from pathlib import Path
+from typing import Dict, Optional
+
+# /tmp liegt bei Raspberry Pi OS auf der SD-Karte, /dev/shm ist ein tmpfs
+STATS_FILE = Path("/dev/shm/writes.json")
+LOCK_FILE = Path("/dev/shm/writes.lock")
+HISTORY_FILE = Path("/media/data/writes.json")
+KEEP_DAYS = 31
+# Hochrechnung erst nach einer Stunde des Tages
+MIN_DAY_FRACTION = 1 / 24
+MAX_STRETCH = 8.0
+
+DATABASE = "database"
+SETTINGS = "settings"
+CONFIG = "config"
+LOG = "log"
+CACHE = "cache"
+
+Totals = Dict[str, Dict[str, Dict[str, int]]]
+
+
+@contextmanager
+def _locked():
+    # Dienste laufen in eigenen Prozessen
+    with LOCK_FILE.open("a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _load() -> Totals:
+    for file in (STATS_FILE, HISTORY_FILE):
+        try:
+            return json.loads(file.read_text())
+        except (FileNotFoundError, ValueError):
+            continue
+    return {}
+
+
+def account(subsystem: str, size: int, syncs: int = 0) -> None:
+    """
+    Geschriebene Bytes und Synchronisierungen eines Subsystems zählen.
+    """
+    today = date.today().isoformat()
+    with _locked():
+        totals = _load()
+        if totals and today not in totals:
+            # Tageswechsel, den Verlauf auf der SD-Karte sichern
+            for day in sorted(totals)[:-KEEP_DAYS]:
+                del totals[day]
+            history = json.dumps(totals)
+            HISTORY_FILE.write_text(history)
+            totals.setdefault(today, {})[SETTINGS] = {
+                "bytes": len(history),
+                "syncs": 0,
+            }
+        counter = totals.setdefault(today, {}).setdefault(
+            subsystem, {"bytes": 0, "syncs": 0}
+        )
+        counter["bytes"] += size
+        counter["syncs"] += syncs
+        STATS_FILE.write_text(json.dumps(totals))
+
+
+def persist() -> None:
+    """
+    Summen vor dem Herunterfahren auf die SD-Karte übernehmen.
+    """
+    with _locked():
+        totals = _load()
+        if totals:
+            HISTORY_FILE.write_text(json.dumps(totals))
+
+
+def write_text(path: Path, text: str, subsystem: str = CONFIG) -> None:
+    """
+    Path.write_text mit Buchführung.
+    """
+    path.write_text(text)
+    account(subsystem, len(text.encode()))
+
+
+def totals() -> Totals:
+    """
+    Summen je Tag und Subsystem
+    """
+    with _locked():
+        return _load()
+
+
+def day_total(day: Optional[str] = None) -> int:
+    day = day or date.today().isoformat()
+    return sum(counter["bytes"] for counter in totals().get(day, {}).values())
+
+
+def stretch_factor(budget: Optional[float]) -> float:
+    """
+    Faktor für die Intervalle zum Speichern.
+
+    budget sind die Bytes pro Tag. Liegt der hochgerechnete Verbrauch
+    des Tages darüber, wird im gleichen Verhältnis gestreckt.
+    """
+    if not budget:
+        return 1.0
+    now = datetime.now()
+    seconds = now.hour * 3600 + now.minute * 60 + now.second
+    fraction = max(seconds / 86400, MIN_DAY_FRACTION)
+    projected = day_total() / fraction
+    return min(max(projected / budget, 1.0), MAX_STRETCH)
+
+
+def io_written() -> Optional[int]:
+    """
+    Bytes, die der aktuelle Thread an das Speichermedium gegeben hat.
+
+    None, wenn der Kernel keine I/O-Statistik liefert.
+    """
+    try:
+        with open("/proc/thread-self/io") as fd:
+            for line in fd:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class LogCounter(Handler):
+    """
+    Zählt die Bytes der Logeinträge und meldet sie gesammelt.
+    """
+
+    def __init__(self, interval: float = 600):
+        super().__init__()
+        self.interval = interval
+        self.size = 0
+        self.next_report = time.monotonic() + interval
+
+    def emit(self, record: LogRecord) -> None:
+        self.size += len(self.format(record)) + 1
+        if time.monotonic() > self.next_report:
+            self.next_report = time.monotonic() + self.interval
+            size, self.size = self.size, 0
+            try:
+                account(LOG, size)
+            except OSError:
+                self.handleError(record)